@@ -0,0 +1,147 @@
+#! /usr/bin/env python3
+import fiona
+import json
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+import sqlite3
+import sys
+
+from maushold.export import EXPORT_DIR
+from maushold.models import CensusCategory
+from maushold.shards import sources
+from pathlib import Path
+from pyproj import CRS
+from shapely.geometry import mapping
+
+# TIGER/Line geometries are NAD83 longitude/latitude.
+CRS_EPSG = 4269
+BATCH_SIZE = 65_536
+
+FGB_SCHEMA = {
+    "geometry": "MultiPolygon",
+    "properties": {
+        "geo_id": "str",
+        "clat": "float",
+        "clon": "float",
+        "area": "float",
+        "housing": "int",
+        "pop": "int",
+    },
+}
+
+PARQUET_SCHEMA = pa.schema([
+    ("geo_id", pa.string()),
+    ("clat", pa.float64()),
+    ("clon", pa.float64()),
+    ("area", pa.float64()),
+    ("housing", pa.int64()),
+    ("pop", pa.int64()),
+    ("bbox", pa.struct([
+        ("xmin", pa.float64()),
+        ("ymin", pa.float64()),
+        ("xmax", pa.float64()),
+        ("ymax", pa.float64()),
+    ])),
+    ("geometry", pa.binary()),
+])
+
+def read_rows(dbs: list[sqlite3.Connection], table: str):
+    """Rows in geo_id order, which keeps each state, county and tract contiguous."""
+    for db in dbs:
+        cur = db.execute(f"""SELECT geo_id, CAST(clat AS REAL), CAST(clon AS REAL), area,
+                                    COALESCE(housing, 0), COALESCE(pop, 0),
+                                    minX, minY, maxX, maxY, geometry
+                             FROM {table}
+                             ORDER BY geo_id""")
+        while rows := cur.fetchmany(BATCH_SIZE):
+            yield rows
+
+def total_bounds(dbs: list[sqlite3.Connection], table: str) -> list[float]:
+    bounds = [db.execute(f"SELECT MIN(minX), MIN(minY), MAX(maxX), MAX(maxY) FROM {table}").fetchone() for db in dbs]
+    return [min(b[0] for b in bounds), min(b[1] for b in bounds), max(b[2] for b in bounds), max(b[3] for b in bounds)]
+
+def to_multipolygon(geom):
+    return shapely.MultiPolygon([geom]) if geom.geom_type == "Polygon" else geom
+
+def write_flatgeobuf(dbs: list[sqlite3.Connection], table: str, path: Path):
+    """
+    Write `table` as FlatGeobuf with its packed Hilbert R-tree, so clients can
+    read the index and then only the features inside a bbox with range requests.
+    """
+    tmp = path.with_name(f"{path.stem}.tmp{path.suffix}")
+    with fiona.open(tmp, "w", driver="FlatGeobuf", schema=FGB_SCHEMA, crs=f"EPSG:{CRS_EPSG}", SPATIAL_INDEX="YES") as dst:
+        for rows in read_rows(dbs, table):
+            geoms = shapely.from_wkb([row[10] for row in rows])
+            dst.writerecords({
+                "geometry": mapping(to_multipolygon(geom)),
+                "properties": {
+                    "geo_id": row[0], "clat": row[1], "clon": row[2],
+                    "area": row[3], "housing": row[4], "pop": row[5],
+                },
+            } for row, geom in zip(rows, geoms))
+    tmp.replace(path)
+
+def geo_metadata(bbox: list[float]) -> bytes:
+    """GeoParquet 1.1 metadata, declaring the bbox column as a covering so readers can skip row groups."""
+    return json.dumps({
+        "version": "1.1.0",
+        "primary_column": "geometry",
+        "columns": {
+            "geometry": {
+                "encoding": "WKB",
+                "geometry_types": ["Polygon", "MultiPolygon"],
+                "crs": CRS.from_epsg(CRS_EPSG).to_json_dict(),
+                "bbox": bbox,
+                "covering": {
+                    "bbox": {
+                        "xmin": ["bbox", "xmin"],
+                        "ymin": ["bbox", "ymin"],
+                        "xmax": ["bbox", "xmax"],
+                        "ymax": ["bbox", "ymax"],
+                    },
+                },
+            },
+        },
+    }).encode()
+
+def write_geoparquet(dbs: list[sqlite3.Connection], table: str, path: Path):
+    """
+    Write `table` as GeoParquet with one row group per BATCH_SIZE rows. Rows are
+    in geo_id order, so each row group covers a compact area and its bbox column
+    statistics let readers prune by bbox.
+    """
+    schema = PARQUET_SCHEMA.with_metadata({"geo": geo_metadata(total_bounds(dbs, table))})
+    tmp = path.with_name(f"{path.stem}.tmp{path.suffix}")
+    with pq.ParquetWriter(tmp, schema, compression="zstd") as writer:
+        for rows in read_rows(dbs, table):
+            columns = list(zip(*rows))
+            batch = pa.Table.from_arrays([
+                pa.array(columns[0], pa.string()),
+                pa.array(columns[1], pa.float64()),
+                pa.array(columns[2], pa.float64()),
+                pa.array(columns[3], pa.float64()),
+                pa.array(columns[4], pa.int64()),
+                pa.array(columns[5], pa.int64()),
+                pa.StructArray.from_arrays(
+                    [pa.array(columns[i], pa.float64()) for i in range(6, 10)],
+                    names=["xmin", "ymin", "xmax", "ymax"],
+                ),
+                pa.array(columns[10], pa.binary()),
+            ], schema=schema)
+            writer.write_table(batch, row_group_size=BATCH_SIZE)
+    tmp.replace(path)
+
+
+if __name__ == "__main__":
+    db_path = sys.argv[1] if len(sys.argv) > 1 else "./data/census.db"
+    EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+
+    with sqlite3.connect(db_path) as conn:
+        for cat in CensusCategory:
+            table = cat.to_table()
+            dbs = sources(conn, table)
+            print("Writing FlatGeobuf for ", table)
+            write_flatgeobuf(dbs, table, EXPORT_DIR / f"{cat.value}.fgb")
+            print("Writing GeoParquet for ", table)
+            write_geoparquet(dbs, table, EXPORT_DIR / f"{cat.value}.parquet")
@@ -1,18 +1,34 @@
+import asyncio
 import json
 import os
+from functools import lru_cache
 from typing import Optional
 
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, status
+from fastapi import FastAPI, HTTPException, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic.errors import PydanticTypeError
 from shapely import geometry
 from shapely.geometry.base import shapely
-from starlette.responses import HTMLResponse
+from starlette.responses import HTMLResponse, JSONResponse
+from maushold.admission import Admission, lane_from_env
+from maushold.cache import ConditionalGetMiddleware
+from maushold.db import ROW_PAGE_SIZE
+from maushold.delta import SessionStore, start_session, update_session
+from maushold.export import export_path
+from maushold.executor import LoopLagMonitor, as_shapely, run_geometry, shutdown as shutdown_executor
+from maushold.files import file_response
+from maushold.jobs import JobManager
 from maushold.sqlite import SqliteDB, Sqlite3Connector 
 from maushold.pg import PgConnector, PgDB
-from maushold.models import CensusCategory, DbRow, GeoRefPopQuery, GeoJSON, PopQuery, PopTotal, Unit, Feature, GeometryCollection
+from maushold.models import CensusCategory, DbRow, GeoRefPopQuery, GeoJSON, GeometryFormat, JobFormat, JobInfo, JobRequest, JobStatus, PopDelta, PopQuery, PopTotal, RadiusPopTotal, RadiusQuery, Unit, Feature, GeometryCollection
+from maushold.grid import approximate_pop
+from maushold.patterns import IdPattern, PatternKind
+from maushold.radius import get_index, needs_database
+from maushold.snapshot import get_snapshot
+from maushold.topojson import to_topojson
 from maushold.transform import make_buffered_geo
 
 load_dotenv()
@@ -22,11 +38,29 @@ pg_pass = os.getenv("PGPASS")
 pg_host = os.getenv("PGHOST")
 pg_db = os.getenv("PGDB")
 DSN = f"user={pg_user} password={pg_pass} host={pg_host} dbname={pg_db}"
-pool = PgConnector(DSN, num_workers=32, timeout=120)
+
+# The pool holds exactly one connection per lane slot, counting the lane background
+# jobs run in, so a burst of heavy polygons or exports can never take the
+# connections cheap id lookups need, and nothing waits in the pool itself.
+# Lanes and the pool are per process: every uvicorn worker opens POOL_SIZE
+# connections at startup, so workers x POOL_SIZE must stay below the server's
+# max_connections. Size the lanes with the MAUSHOLD_<LANE>_* variables to fit.
+admission = Admission(
+    cheap=lane_from_env("cheap", concurrency=16, queue_depth=512, timeout=10),
+    standard=lane_from_env("standard", concurrency=12, queue_depth=64, timeout=30),
+    heavy=lane_from_env("heavy", concurrency=4, queue_depth=8, timeout=120),
+)
+job_lane = lane_from_env("jobs", concurrency=2, queue_depth=0, timeout=3600)
+POOL_SIZE = admission.concurrency + job_lane.concurrency
+pool = PgConnector(DSN, min_size=POOL_SIZE, max_size=POOL_SIZE, timeout=120)
 
 # sqlite_path = "file:./data/census.db?mode=ro&cache=shared&journal_mode=off&sync=off"
 # pool = Sqlite3Connector(sqlite_path, uri=True)
 
+sessions = SessionStore()
+jobs = JobManager(pool, job_lane)
+loop_lag = LoopLagMonitor()
+
 app = FastAPI(title="Maushold", description="Simple API for getting georeferenced population data")
 
 origins = [
@@ -42,116 +76,296 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
+)
+
+# Census data only changes between loads, so GET responses for the data routes are
+# answered from the client's cache via ETags; large bodies are gzipped.
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+app.add_middleware(
+    ConditionalGetMiddleware,
+    segments={cat.value for cat in CensusCategory} | {"bbox", "polygon"},
 )
 
 app.mount("/assets", StaticFiles(directory="./viewer/dist/assets", html=True), name="assets")
 
-@app.get("/")
-async def root():
+@lru_cache(maxsize=1)
+def index_html() -> str:
     with open("./viewer/dist/index.html") as f:
-        html = f.read()
-    return HTMLResponse(html)
+        return f.read()
 
-@app.get("/{cat}")
-async def get_cat_ids(cat: CensusCategory, limit=10_000, offset=0) -> list[str]:
-    async with pool.connection() as db:
-        data = await db.get_ids(cat, limit, offset)
-    return data
+@app.on_event("startup")
+async def start_jobs():
+    await jobs.start()
+    loop_lag.start()
 
-@app.get("/{cat}/{id}/pop")
-async def get_cat_pop(cat: CensusCategory, id: str) -> list[PopQuery]:
-    r"""
-    Retrieve population by FIPS id. Values can be matched using the '*' operator. Use commas to separate multiple ids.
+@app.on_event("shutdown")
+async def stop_jobs():
+    await jobs.stop()
+    await loop_lag.stop()
+    shutdown_executor()
 
-    Ex: /tract/20109\*,01001\*/pop
+@app.get("/")
+async def root():
+    return HTMLResponse(index_html())
+
+@app.get("/stats/loop")
+async def get_loop_lag() -> dict[str, float]:
+    """How late, in milliseconds, the event loop has been waking a 100 ms timer. Sustained lag means something is blocking it."""
+    return loop_lag.stats()
+
+@app.post("/jobs", status_code=202)
+async def post_job(job: JobRequest) -> JobInfo:
     """
-    res = []
-    async with pool.connection() as db:
-        for code in id.split(","):
-            data = await db.get_pop_data(cat, code)
-            [res.append(item) for item in data]
-    return res
+    Queue a large query to run in the background: either a geometry, answered like /polygon/{cat},
+    or an id pattern, answered with full rows. Poll /jobs/{id} and fetch /jobs/{id}/result when done.
+    """
+    if (job.geometry is None) == (job.id is None):
+        raise HTTPException(status_code=422, detail="give exactly one of geometry or id")
+    try:
+        return await jobs.submit(job)
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=429, detail="too many queued jobs", headers={"Retry-After": "60"})
 
-@app.get("/{cat}/{id}")
-async def get_cat_by_id(cat: CensusCategory, id: str) -> list[DbRow]:
-    r"""
-    Retrieve population by FIPS id. Values can be matched using the '*' operator. Use commas to separate multiple ids.
+@app.get("/jobs/{id}")
+async def get_job(id: str) -> JobInfo:
+    job = await jobs.get(id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="unknown job")
+    return job.info
 
-    Ex: /tract/20109\*,01001\*
+@app.get("/jobs/{id}/result")
+async def get_job_result(request: Request, id: str):
+    job = await jobs.get(id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="unknown job")
+    if job.info.status != JobStatus.done:
+        raise HTTPException(status_code=409, detail=f"job is {job.info.status.value}")
+    if job.info.format == JobFormat.parquet:
+        return file_response(request, job.path, "application/vnd.apache.parquet", job.path.name)
+    return file_response(request, job.path, "application/x-ndjson", job.path.name)
+
+@app.get("/export/{name}")
+@app.head("/export/{name}")
+async def get_export(request: Request, name: str):
     """
-    async with pool.connection() as db:
-        res = []
-        for code in id.split(","):
-            data = await db.get_row_data(cat, code)
-            [res.append(item) for item in data]
-    return res
+    A whole category written by export_setup.py, as FlatGeobuf (/export/block.fgb) or GeoParquet
+    (/export/block.parquet). Range requests are honoured, so clients can read the spatial index or
+    row group statistics and fetch only the features inside a bbox.
+    """
+    try:
+        path, media_type = export_path(name)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="unknown export")
+    if not path.is_file():
+        raise HTTPException(status_code=404, detail="export has not been written")
+    return file_response(request, path, media_type, name)
 
 @app.get("/bbox/{cat}")
 async def get(cat: CensusCategory, minX: float, minY: float, maxX: float, maxY: float) -> list[GeoRefPopQuery]:
-    poly = shapely.Polygon([(minX, minY), (maxX, minY), (maxX,maxY), (minX, maxY), (minX, minY)])
-    async with pool.connection() as db:
+    poly = await run_geometry(shapely.box, minX, minY, maxX, maxY)
+    async with admission.admit(cat, poly) as lane, pool.connection(lane.timeout) as db:
         data = await db.get_row_by_geometry(cat, poly)
     return data
 
 @app.get("/bbox/{cat}/pop")
-async def get_row_total(cat: CensusCategory, minX: float, minY: float, maxX: float, maxY: float) -> PopTotal:
-    poly = shapely.Polygon([(minX, minY), (maxX, minY), (maxX,maxY), (minX, maxY), (minX, minY)])
-    async with pool.connection() as db:
+async def get_row_total(cat: CensusCategory, minX: float, minY: float, maxX: float, maxY: float, approximate: bool = False) -> PopTotal:
+    poly = await run_geometry(shapely.box, minX, minY, maxX, maxY)
+    if approximate:
+        async with admission.admit(cat) as lane, pool.connection(lane.timeout) as db:
+            pop, error = await approximate_pop(db, poly)
+        return PopTotal(pop=pop, error=error)
+    async with admission.admit(cat, poly) as lane, pool.connection(lane.timeout) as db:
         data = await db.get_row_by_geometry(cat, poly)
     pop = sum([row.pop for row in data if row.pop is not None])
     return PopTotal(pop=pop)
 
 @app.post("/polygon/{cat}")
 async def post_pop_by_polygon(cat: CensusCategory, geometry: GeoJSON, buffer: Optional[float]=None, unit: Optional[Unit]=None) -> list[GeoRefPopQuery]:
-    async with pool.connection() as db:
-        if unit is not None and buffer is not None:
-            geometry = make_buffered_geo(geometry, buffer, unit)
-        data = await db.get_row_by_geometry(cat, geometry)
+    if unit is not None and buffer is not None:
+        geometry = await run_geometry(make_buffered_geo, geometry, buffer, unit, heavy=True)
+    geom = await as_shapely(geometry)
+    async with admission.admit(cat, geom) as lane, pool.connection(lane.timeout) as db:
+        data = await db.get_row_by_geometry(cat, geom)
     return data
 
 @app.get("/polygon/{cat}")
 async def get_pop_by_polygon(cat: CensusCategory, json_str: str, buffer: Optional[float]=None, unit: Optional[Unit]=None) -> list[GeoRefPopQuery]:
-    async with pool.connection() as db:
-        geojson = json.loads(json_str)
-        try:
-            geometry = GeoJSON(**geojson)
-            if unit is not None and buffer is not None:
-                geometry = make_buffered_geo(geometry, buffer, unit)
-        except PydanticTypeError:
-            raise HTTPException(status_code=422, detail="invalid geojson")
-        data = await db.get_row_by_geometry(cat, geometry)
+    geojson = json.loads(json_str)
+    try:
+        geometry = GeoJSON(**geojson)
+        if unit is not None and buffer is not None:
+            geometry = await run_geometry(make_buffered_geo, geometry, buffer, unit, heavy=True)
+    except PydanticTypeError:
+        raise HTTPException(status_code=422, detail="invalid geojson")
+    geom = await as_shapely(geometry)
+    async with admission.admit(cat, geom) as lane, pool.connection(lane.timeout) as db:
+        data = await db.get_row_by_geometry(cat, geom)
     return data
 
 @app.post("/polygon/{cat}/pop")
-async def get_pop_total_by_polygon(cat: CensusCategory, geometry: GeoJSON, buffer: Optional[float]=None, unit: Optional[Unit]=None) -> PopTotal:
-    async with pool.connection() as db:
-        if unit is not None and buffer is not None:
-            geometry = make_buffered_geo(geometry, buffer, unit)
-        data = await db.get_row_by_geometry(cat, geometry)
+async def get_pop_total_by_polygon(cat: CensusCategory, geometry: GeoJSON, buffer: Optional[float]=None, unit: Optional[Unit]=None, approximate: bool = False) -> PopTotal:
+    """
+    Total population inside a polygon. With `approximate=true` the total is estimated from
+    the gridded block population instead, and returned with a bound on its error.
+    """
+    if unit is not None and buffer is not None:
+        geometry = await run_geometry(make_buffered_geo, geometry, buffer, unit, heavy=True)
+    geom = await as_shapely(geometry)
+    if approximate:
+        async with admission.admit(cat) as lane, pool.connection(lane.timeout) as db:
+            pop, error = await approximate_pop(db, geom)
+        return PopTotal(pop=pop, error=error)
+    async with admission.admit(cat, geom) as lane, pool.connection(lane.timeout) as db:
+        data = await db.get_row_by_geometry(cat, geom)
     pop = sum([row.pop for row in data if row.pop is not None])
     return PopTotal(pop=pop)
 
 @app.get("/polygon/{cat}/pop")
-async def post_pop_total_by_polygon(cat: CensusCategory, json_str: str) -> PopTotal:
-    async with pool.connection() as db:
-        geojson = json.loads(json_str)
-        try:
-            geometry = GeoJSON(**geojson)
-        except PydanticTypeError:
-            raise HTTPException(status_code=422, detail="invalid geojson")
-        data = await db.get_row_by_geometry(cat, geometry)
-        pop = sum([row.pop for row in data if row.pop is not None])
+async def post_pop_total_by_polygon(cat: CensusCategory, json_str: str, buffer: Optional[float]=None, unit: Optional[Unit]=None, approximate: bool = False) -> PopTotal:
+    geojson = json.loads(json_str)
+    try:
+        geometry = GeoJSON(**geojson)
+        if unit is not None and buffer is not None:
+            geometry = await run_geometry(make_buffered_geo, geometry, buffer, unit, heavy=True)
+    except PydanticTypeError:
+        raise HTTPException(status_code=422, detail="invalid geojson")
+    geom = await as_shapely(geometry)
+    if approximate:
+        async with admission.admit(cat) as lane, pool.connection(lane.timeout) as db:
+            pop, error = await approximate_pop(db, geom)
+        return PopTotal(pop=pop, error=error)
+    async with admission.admit(cat, geom) as lane, pool.connection(lane.timeout) as db:
+        data = await db.get_row_by_geometry(cat, geom)
+    pop = sum([row.pop for row in data if row.pop is not None])
     return PopTotal(pop=pop)
 
+@app.get("/polygon/{cat}/geometry")
 @app.post("/polygon/{cat}/geometry")
-async def post_geometry(cat: CensusCategory, geojson_str: str) -> GeometryCollection:
-    async with pool.connection() as db:
-        geojson = json.loads(geojson_str)
-        try:
-            geometry = GeoJSON(**geojson)
-        except PydanticTypeError:
-            raise HTTPException(status_code=422, detail="invalid geojson")
-        data = await db.get_intersected_geometries(cat, geometry)
-        feat = [Feature(geometry=geo) for geo in data]
-        gc = GeometryCollection(features=feat)
+async def post_geometry(cat: CensusCategory, geojson_str: str, format: GeometryFormat = GeometryFormat.geojson, quantize: float = 1e5) -> GeometryCollection:
+    """
+    Geometries of the units intersecting a polygon. With `format=topojson` shared boundaries are
+    stored once as arcs, with coordinates snapped to a `quantize` x `quantize` grid and delta-encoded.
+    """
+    geojson = json.loads(geojson_str)
+    try:
+        geometry = GeoJSON(**geojson)
+    except PydanticTypeError:
+        raise HTTPException(status_code=422, detail="invalid geojson")
+    geom = await as_shapely(geometry)
+    async with admission.admit(cat, geom) as lane, pool.connection(lane.timeout) as db:
+        data = await db.get_intersected_geometries(cat, geom)
+    if format == GeometryFormat.topojson:
+        geoms = await run_geometry(lambda: [geo.to_shapely() for geo in data])
+        return JSONResponse(await run_geometry(to_topojson, geoms, quantize, heavy=True))
+    feat = [Feature(geometry=geo) for geo in data]
+    gc = GeometryCollection(features=feat)
     return gc
+
+@app.post("/polygon/{cat}/pop/session")
+async def post_pop_session(cat: CensusCategory, geometry: GeoJSON) -> PopDelta:
+    """
+    Start tracking a polygon whose shape will change, e.g. a re-issued storm warning.
+    Returns a handle along with the total and every unit inside.
+    """
+    geom = await as_shapely(geometry)
+    async with admission.admit(cat, geom) as lane, pool.connection(lane.timeout) as db:
+        return await start_session(db, sessions, cat, geom)
+
+@app.post("/polygon/{cat}/pop/session/{handle}")
+async def post_pop_session_update(cat: CensusCategory, handle: str, geometry: GeoJSON) -> PopDelta:
+    """
+    Move a tracked polygon to a new geometry. Only the regions that changed are queried;
+    returns the new total with the units that entered and left.
+    """
+    geom = await as_shapely(geometry)
+    async with sessions.checkout(handle) as session:
+        if session is None:
+            raise HTTPException(status_code=404, detail="unknown or expired session")
+        if session.cat != cat:
+            raise HTTPException(status_code=422, detail=f"session tracks {session.cat.value}")
+        changed = await run_geometry(shapely.symmetric_difference, session.geometry, geom)
+        async with admission.admit(cat, changed) as lane, pool.connection(lane.timeout) as db:
+            return await update_session(db, handle, session, geom)
+
+@app.post("/radius/{cat}/pop")
+async def post_pop_by_radius(cat: CensusCategory, query: RadiusQuery) -> list[RadiusPopTotal]:
+    """
+    Population within a radius of many points at once. Units are counted when their
+    centroid lies within the great-circle radius of the point.
+    """
+    # Loaded indexes and snapshots are answered from memory; only the first query for a
+    # category without a snapshot reads every centroid from the database.
+    if needs_database(cat):
+        async with admission.heavy.admit(), pool.connection(admission.heavy.timeout) as db:
+            index = await get_index(db, cat)
+    else:
+        index = await get_index(None, cat)
+    return await run_geometry(index.query, query.points, query.unit, query.ids)
+
+# The /{cat} routes match any one or two segment path, so they are registered last.
+@app.get("/{cat}")
+async def get_cat_ids(response: Response, cat: CensusCategory, limit: int = 10_000, offset: int = 0, after: Optional[str] = None) -> list[str]:
+    """
+    List ids in geo_id order. Pass `after` (an empty value starts from the beginning) to page by
+    cursor instead of offset; the cursor for the next page is returned in the X-Next-Cursor header.
+    """
+    snapshot = get_snapshot(cat)
+    if snapshot is not None:
+        if after is None:
+            return await asyncio.to_thread(snapshot.ids, offset, limit)
+        page = await asyncio.to_thread(snapshot.ids_after, after, limit)
+    else:
+        async with admission.admit(cat) as lane, pool.connection(lane.timeout) as db:
+            if after is None:
+                return await db.get_ids(cat, limit, offset)
+            page = await db.get_ids_after(cat, after, limit)
+    if page.next is not None:
+        response.headers["X-Next-Cursor"] = page.next
+    return page.ids
+
+@app.get("/{cat}/{id}/pop")
+async def get_cat_pop(cat: CensusCategory, id: str) -> list[PopQuery]:
+    r"""
+    Retrieve population by FIPS id. Values can be matched using the '*' operator. Use commas to separate multiple ids.
+
+    Ex: /tract/20109\*,01001\*/pop
+    """
+    codes = id.split(",")
+    snapshot = get_snapshot(cat)
+    # The snapshot answers patterns it can bound by a prefix; the rest go to the database indexes.
+    if snapshot is not None and all(IdPattern(code).kind in (PatternKind.exact, PatternKind.prefix) for code in codes):
+        return await asyncio.to_thread(lambda: [row for code in codes for row in snapshot.pop_data(snapshot.find(code))])
+    res = []
+    async with admission.admit(cat, ids=codes) as lane, pool.connection(lane.timeout) as db:
+        for code in codes:
+            data = await db.get_pop_data(cat, code)
+            [res.append(item) for item in data]
+    return res
+
+@app.get("/{cat}/{id}")
+async def get_cat_by_id(cat: CensusCategory, id: str, after: Optional[str] = None) -> list[DbRow]:
+    r"""
+    Retrieve population by FIPS id. Values can be matched using the '*' operator. Use commas to separate multiple ids.
+    Results come in pages of 500 per id in geo_id order; pass the X-Next-Cursor header back as `after` for the next page.
+    With several ids the cursor holds one position per id, comma separated, left empty for ids that are done.
+
+    Ex: /tract/20109\*,01001\*
+    """
+    codes = id.split(",")
+    afters: list[Optional[str]] = after.split(",") if after is not None else [None] * len(codes)
+    if len(afters) != len(codes):
+        raise HTTPException(status_code=422, detail="after must hold one cursor per id")
+    async with admission.admit(cat, ids=codes) as lane, pool.connection(lane.timeout) as db:
+        res = []
+        cursors = []
+        for code, start in zip(codes, afters):
+            if after is not None and start == "" and len(codes) > 1:
+                cursors.append("")
+                continue
+            data = await db.get_row_json(cat, code, after=start)
+            cursors.append(data[-1][0] if len(data) == ROW_PAGE_SIZE else "")
+            [res.append(row) for _, row in data]
+    # Rows arrive already serialized with their stored GeoJSON, so skip response validation.
+    headers = {"X-Next-Cursor": ",".join(cursors)} if any(cursors) else None
+    return Response(b"[" + b",".join(res) + b"]", media_type="application/json", headers=headers)
@@ -0,0 +1,166 @@
+import asyncio
+import math
+import os
+
+from contextlib import asynccontextmanager
+
+import shapely
+from fastapi import HTTPException
+
+from .models import CensusCategory
+from .patterns import IdPattern, PatternKind
+
+# Relative cost of scanning one square degree of each category.
+CATEGORY_WEIGHT = {
+    CensusCategory.state: 1,
+    CensusCategory.county: 2,
+    CensusCategory.tract: 10,
+    CensusCategory.block_group: 20,
+    CensusCategory.block: 200,
+}
+
+# Smallest area charged for a query, so points and tiny polygons still cost something.
+MIN_AREA = 1e-4
+
+# Approximate number of units in each category, from the 2020 census.
+CATEGORY_UNITS = {
+    CensusCategory.state: 56,
+    CensusCategory.county: 3_234,
+    CensusCategory.tract: 85_528,
+    CensusCategory.block_group: 242_335,
+    CensusCategory.block: 8_132_968,
+}
+
+# Rows an id lookup may touch per unit of cost.
+ROWS_PER_COST = 100
+
+# Length of the geo_id prefix naming each level of the hierarchy, and how many
+# distinct prefixes of that length there are.
+PREFIX_COUNTS = [(0, 1), (2, 56), (5, 3_234), (11, 85_528), (12, 242_335), (15, 8_132_968)]
+
+def distinct_prefixes(length: int) -> float:
+    """Distinct geo_id prefixes of `length` digits, interpolated geometrically between levels."""
+    for (lo, lo_count), (hi, hi_count) in zip(PREFIX_COUNTS, PREFIX_COUNTS[1:]):
+        if length <= hi:
+            return lo_count * (hi_count / lo_count) ** ((length - lo) / (hi - lo))
+    return PREFIX_COUNTS[-1][1]
+
+def estimate_cost(cat: CensusCategory, geom) -> float:
+    """
+    Rough cost of a geometry query: the number of units the bbox can touch,
+    scaled up slowly with the number of vertices every candidate is tested against.
+    """
+    if geom is None or geom.is_empty:
+        return 0.0
+    minX, minY, maxX, maxY = geom.bounds
+    area = max((maxX - minX) * (maxY - minY), MIN_AREA)
+    vertices = shapely.get_num_coordinates(geom)
+    return CATEGORY_WEIGHT[cat] * area * (1 + math.log10(1 + vertices))
+
+def estimate_id_cost(cat: CensusCategory, ids: list[str]) -> float:
+    """
+    Rough cost of looking up id patterns: the rows each can match. Prefixes
+    narrow the ids by as many units as share them, suffixes tenfold per digit,
+    and patterns with no btree anchor (infix and scan) are charged the whole table.
+    """
+    rows = 0.0
+    for id in ids:
+        pattern = IdPattern(id)
+        if pattern.kind == PatternKind.exact:
+            rows += 1
+        elif pattern.kind == PatternKind.prefix:
+            rows += max(1, CATEGORY_UNITS[cat] / distinct_prefixes(len(id.split("*", 1)[0])))
+        elif pattern.kind == PatternKind.suffix:
+            rows += max(1, CATEGORY_UNITS[cat] / 10 ** len(id.rsplit("*", 1)[-1]))
+        else:
+            rows += CATEGORY_UNITS[cat]
+    return rows / ROWS_PER_COST
+
+class Lane:
+    """
+    A concurrency limit with a bounded queue in front of it. Requests beyond the
+    queue depth are refused immediately, requests that wait longer than
+    `queue_timeout` are dropped, and admitted requests get `timeout` seconds.
+    """
+    def __init__(self, name: str, concurrency: int, queue_depth: int, timeout: float, queue_timeout: float = 5):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.sem = asyncio.Semaphore(concurrency)
+        self.waiting = 0
+
+    def retry_after(self) -> str:
+        return str(max(1, math.ceil(self.timeout / self.concurrency)))
+
+    def reject(self, status_code: int, detail: str) -> HTTPException:
+        return HTTPException(status_code=status_code, detail=detail,
+                             headers={"Retry-After": self.retry_after()})
+
+    @asynccontextmanager
+    async def admit(self):
+        if self.sem.locked():
+            if self.waiting >= self.queue_depth:
+                raise self.reject(429, f"{self.name} queries are saturated")
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self.sem.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                raise self.reject(503, f"{self.name} queries are saturated")
+            finally:
+                self.waiting -= 1
+        else:
+            await self.sem.acquire()
+        try:
+            async with asyncio.timeout(self.timeout):
+                yield self
+        except TimeoutError:
+            raise self.reject(503, f"{self.name} query timed out")
+        finally:
+            self.sem.release()
+
+def lane_from_env(name: str, concurrency: int, queue_depth: int, timeout: float) -> Lane:
+    """
+    A lane whose settings can be overridden by MAUSHOLD_<NAME>_CONCURRENCY,
+    MAUSHOLD_<NAME>_QUEUE_DEPTH and MAUSHOLD_<NAME>_TIMEOUT.
+    """
+    prefix = f"MAUSHOLD_{name.upper()}"
+    return Lane(name,
+                concurrency=int(os.getenv(f"{prefix}_CONCURRENCY", str(concurrency))),
+                queue_depth=int(os.getenv(f"{prefix}_QUEUE_DEPTH", str(queue_depth))),
+                timeout=float(os.getenv(f"{prefix}_TIMEOUT", str(timeout))))
+
+class Admission:
+    def __init__(self, cheap: Lane, standard: Lane, heavy: Lane, standard_cost: float = 1, heavy_cost: float = 100):
+        self.cheap = cheap
+        self.standard = standard
+        self.heavy = heavy
+        self.standard_cost = standard_cost
+        self.heavy_cost = heavy_cost
+
+    @property
+    def concurrency(self) -> int:
+        """Queries the lanes can run at once, i.e. the connections they can hold."""
+        return self.cheap.concurrency + self.standard.concurrency + self.heavy.concurrency
+
+    def lane_for_cost(self, cost: float) -> Lane:
+        if cost >= self.heavy_cost:
+            return self.heavy
+        if cost >= self.standard_cost:
+            return self.standard
+        return self.cheap
+
+    def lane_for(self, cat: CensusCategory, geom) -> Lane:
+        return self.lane_for_cost(estimate_cost(cat, geom))
+
+    def admit(self, cat: CensusCategory, geom=None, ids: list[str] | None = None):
+        """
+        Admit a query into the lane for its estimated cost, from its geometry or
+        the id patterns it looks up; queries with neither are cheap.
+        """
+        if ids is not None:
+            return self.lane_for_cost(estimate_id_cost(cat, ids)).admit()
+        if geom is None:
+            return self.cheap.admit()
+        return self.lane_for(cat, geom).admit()
@@ -0,0 +1,77 @@
+import hashlib
+import os
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Bump whenever the census data is reloaded; every ETag changes with it.
+DATA_VERSION = os.getenv("MAUSHOLD_DATA_VERSION", "census2020")
+
+def make_etag(version: str, scope: Scope, gzip: bool) -> str:
+    """
+    Strong ETag for a request against immutable data. The response is fully
+    determined by the data version and the request, so neither the database nor
+    the body is needed to compute it.
+    """
+    key = hashlib.sha256()
+    key.update(version.encode())
+    key.update(b"\0" + scope["path"].encode())
+    query = b"&".join(sorted(scope.get("query_string", b"").split(b"&")))
+    key.update(b"\0" + query)
+    key.update(b"\0gzip" if gzip else b"\0identity")
+    return f'"{key.hexdigest()[:32]}"'
+
+def matches(if_none_match: str, etag: str) -> bool:
+    """
+    Whether If-None-Match names `etag`. A bare '*' only asks whether the resource
+    exists, which can't be known without running the route, so it never matches.
+    """
+    for tag in if_none_match.split(","):
+        if tag.strip().removeprefix("W/") == etag:
+            return True
+    return False
+
+class ConditionalGetMiddleware:
+    """
+    Adds ETag and Cache-Control to GET responses whose first path segment is in
+    `segments`, and answers a matching If-None-Match with 304 before the request
+    reaches a route.
+    """
+    def __init__(self, app: ASGIApp, segments: set[str], version: str = DATA_VERSION, max_age: int = 86_400) -> None:
+        self.app = app
+        self.segments = segments
+        self.version = version
+        self.cache_control = f"public, max-age={max_age}"
+
+    def cacheable(self, scope: Scope) -> bool:
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD"):
+            return False
+        return scope["path"].strip("/").split("/", 1)[0] in self.segments
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if not self.cacheable(scope):
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        etag = make_etag(self.version, scope, "gzip" in headers.get("Accept-Encoding", ""))
+        cache_headers = [
+            (b"etag", etag.encode()),
+            (b"cache-control", self.cache_control.encode()),
+            (b"vary", b"Accept-Encoding"),
+        ]
+        if matches(headers.get("If-None-Match", ""), etag):
+            await send({"type": "http.response.start", "status": 304, "headers": cache_headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_etag(message: Message) -> None:
+            if message["type"] == "http.response.start" and message["status"] == 200:
+                response_headers = MutableHeaders(scope=message)
+                response_headers["ETag"] = etag
+                response_headers["Cache-Control"] = self.cache_control
+                if "accept-encoding" not in response_headers.get("Vary", "").lower():
+                    response_headers.add_vary_header("Accept-Encoding")
+            await send(message)
+
+        await self.app(scope, receive, send_with_etag)
@@ -1,14 +1,42 @@
+import json
+
 from abc import ABC, abstractmethod
+from typing import AsyncIterator
+
+from .models import CensusCategory, DbRow, GeoJSON, GeoRefPopQuery, IdPage, PopQuery
+
+ROW_PAGE_SIZE = 500
+
+# Columns of DbRow other than the geometry, in response order.
+ROW_FIELDS = ("geo_id", "clat", "clon", "minX", "minY", "maxX", "maxY", "area", "housing", "pop")
 
-from .models import CensusCategory, DbRow, GeoJSON, GeoRefPopQuery, PopQuery
+def splice_geometry(fields: dict, geojson: str | bytes) -> bytes:
+    """Serialize a DbRow from its scalar fields and an already encoded GeoJSON geometry."""
+    if isinstance(geojson, str):
+        geojson = geojson.encode()
+    head = json.dumps(fields, separators=(",", ":")).encode()
+    return head[:-1] + b',"geometry":' + geojson + b"}"
 
 class DataBase(ABC):
+    # True when get_row_by_geometry keeps units whose bbox lies within the query
+    # bounds and whose centroid is inside the geometry, rather than every unit
+    # intersecting the geometry.
+    selects_by_bbox = False
+
     @abstractmethod
     async def get_ids(self, cat: CensusCategory, limit: int, offset: int):
         pass
 
     @abstractmethod
-    async def get_row_data(self , table: str, id: str, offset) -> list[DbRow]:
+    async def get_ids_after(self, cat: CensusCategory, after: str, limit: int) -> IdPage:
+        pass
+
+    @abstractmethod
+    async def get_row_data(self, cat: CensusCategory, id: str, offset: int = 0, after: str | None = None) -> list[DbRow]:
+        pass
+
+    @abstractmethod
+    async def get_row_json(self, cat: CensusCategory, id: str, after: str | None = None) -> list[tuple[str, bytes]]:
         pass
 
     @abstractmethod
@@ -16,5 +44,31 @@ class DataBase(ABC):
         pass
 
     @abstractmethod
-    async def get_row_by_geometry(self, cat: CensusCategory, geom: GeoJSON) -> list[GeoRefPopQuery]:
+    async def get_row_by_geometry(self, cat: CensusCategory, geom: GeoJSON, bounds: tuple[float, float, float, float] | None = None) -> list[GeoRefPopQuery]:
+        """`bounds` replaces the bbox of `geom` as the extent units must lie within, where selects_by_bbox."""
+        pass
+
+    @abstractmethod
+    def stream_rows(self, cat: CensusCategory, geom: GeoJSON | None = None, id: str | None = None, batch_size: int = 10_000) -> AsyncIterator[list[dict]]:
+        """
+        Batches of rows for an export. With a geometry the rows are those of
+        get_row_by_geometry; with an id pattern they are full rows whose geometry
+        is the stored GeoJSON text under 'geojson'.
+        """
+        pass
+
+    @abstractmethod
+    async def get_ids_in_geometry(self, cat: CensusCategory, geom: GeoJSON, ids: list[str]) -> set[str]:
+        pass
+
+    @abstractmethod
+    async def get_state_bounds(self) -> dict[str, tuple[float, float, float, float]]:
+        pass
+
+    @abstractmethod
+    async def get_centroids(self, cat: CensusCategory) -> list[tuple[str, float, float, int]]:
+        pass
+
+    @abstractmethod
+    async def get_grid_cells(self, z: int, tiles: list[tuple[int, int]]) -> dict[tuple[int, int], int]:
         pass
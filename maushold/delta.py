@@ -0,0 +1,190 @@
+import asyncio
+import fcntl
+import json
+import os
+import re
+import time
+import uuid
+
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+import shapely
+
+from .db import DataBase
+from .executor import as_shapely, run_geometry
+from .models import CensusCategory, GeoJSON, PopDelta, PopQuery
+
+SESSION_DIR = Path("./data/sessions")
+HANDLE = re.compile(r"[0-9a-f]{32}")
+
+class Session:
+    def __init__(self, cat: CensusCategory, geometry, units: dict[str, int]):
+        self.cat = cat
+        self.geometry = geometry
+        self.units = units
+
+    @property
+    def pop(self) -> int:
+        return sum(self.units.values())
+
+    def dumps(self) -> bytes:
+        return json.dumps({"cat": self.cat.value, "geometry": shapely.to_wkb(self.geometry, hex=True),
+                           "units": self.units}, separators=(",", ":")).encode()
+
+    @classmethod
+    def loads(cls, data: bytes) -> "Session":
+        record = json.loads(data)
+        return cls(CensusCategory(record["cat"]), shapely.from_wkb(record["geometry"]), record["units"])
+
+class SessionStore:
+    """
+    Tracked polygons shared by every worker process, one file per handle under
+    `directory`. Sessions expire after `ttl` seconds unused, and beyond
+    `max_sessions` the least recently used are dropped. Updates to a handle take
+    an exclusive flock on its lock file, so they apply in turn across processes.
+    """
+    def __init__(self, max_sessions: int = 1024, ttl: float = 3600, directory: Path = SESSION_DIR):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.directory = directory
+
+    def _path(self, handle: str) -> Path:
+        return self.directory / f"{handle}.json"
+
+    def _remove(self, handle: str):
+        self._path(handle).unlink(missing_ok=True)
+        (self.directory / f"{handle}.lock").unlink(missing_ok=True)
+
+    def _save(self, handle: str, session: Session):
+        # Writing the file also marks it used, since expiry goes by mtime.
+        path = self._path(handle)
+        tmp = path.with_name(f"{handle}.{uuid.uuid4().hex}.tmp")
+        tmp.write_bytes(session.dumps())
+        tmp.replace(path)
+
+    def _load(self, handle: str) -> Session | None:
+        path = self._path(handle)
+        try:
+            if time.time() - path.stat().st_mtime >= self.ttl:
+                self._remove(handle)
+                return None
+            return Session.loads(path.read_bytes())
+        except FileNotFoundError:
+            return None
+
+    def _expire(self):
+        sessions = []
+        for path in self.directory.glob("*.json"):
+            try:
+                sessions.append((path.stat().st_mtime, path.stem))
+            except FileNotFoundError:
+                pass
+        sessions.sort()
+        cutoff = time.time() - self.ttl
+        for i, (mtime, handle) in enumerate(sessions):
+            if mtime >= cutoff and len(sessions) - i <= self.max_sessions:
+                break
+            self._remove(handle)
+
+    async def create(self, session: Session) -> str:
+        handle = uuid.uuid4().hex
+        self.directory.mkdir(parents=True, exist_ok=True)
+        await asyncio.to_thread(self._save, handle, session)
+        await asyncio.to_thread(self._expire)
+        return handle
+
+    @asynccontextmanager
+    async def checkout(self, handle: str):
+        """
+        Hold the lock on `handle` and yield its session, or None if it is unknown or
+        expired. Changes made to the session are saved when the block exits cleanly.
+        """
+        if not HANDLE.fullmatch(handle) or not self._path(handle).exists():
+            yield None
+            return
+        fd = os.open(self.directory / f"{handle}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # Polled rather than blocking in a thread, so a cancelled request never leaves the lock taken.
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(0.01)
+            session = await asyncio.to_thread(self._load, handle)
+            yield session
+            if session is not None:
+                await asyncio.to_thread(self._save, handle, session)
+        finally:
+            os.close(fd)
+
+# The changed regions are widened by this many degrees when looking for
+# candidates, so units on the old boundary, which belong to neither region's
+# interior, are still found. Candidates are then checked against the new geometry.
+EPSILON = 1e-9
+
+def changes(old, new) -> tuple:
+    """Slightly widened regions new - old and old - new, or None where they are empty."""
+    added = shapely.difference(new, old)
+    removed = shapely.difference(old, new)
+    widen = lambda geom: None if geom.is_empty else shapely.buffer(geom, EPSILON, quad_segs=1, join_style="mitre")
+    return widen(added), widen(removed)
+
+async def start_session(db: DataBase, store: SessionStore, cat: CensusCategory, geometry: GeoJSON) -> PopDelta:
+    geom = await as_shapely(geometry)
+    rows = await db.get_row_by_geometry(cat, geom)
+    units = {row.geo_id: row.pop or 0 for row in rows}
+    handle = await store.create(Session(cat, geom, units))
+    return PopDelta(handle=handle, pop=sum(units.values()),
+                    entered=[PopQuery(geo_id=k, pop=v) for k, v in units.items()], left=[])
+
+async def update_session(db: DataBase, handle: str, session: Session, geometry: GeoJSON) -> PopDelta:
+    """
+    Move a session to a new geometry, querying only the regions that changed.
+    Units that entered must touch new - old, and units that left must touch
+    old - new; both are re-checked against the whole new geometry since a unit
+    can straddle the two, or sit on the old boundary.
+
+    Backends that select by bbox also keep only units inside the query bounds,
+    so the changed regions are queried with the bounds of the whole geometry; if
+    those bounds moved, units far from the edit can enter or leave and the
+    session is recomputed in full.
+
+    Callers hold the session through SessionStore.checkout, which saves it afterwards.
+    """
+    new = await as_shapely(geometry)
+    if db.selects_by_bbox and new.bounds != session.geometry.bounds:
+        rows = await db.get_row_by_geometry(session.cat, new)
+        units = {row.geo_id: row.pop or 0 for row in rows}
+        entered = {k: v for k, v in units.items() if k not in session.units}
+        left = [k for k in session.units if k not in units]
+    else:
+        entered, left = await _changed_units(db, session, new)
+
+    left_units = [PopQuery(geo_id=k, pop=session.units.pop(k)) for k in left]
+    session.units.update(entered)
+    session.geometry = new
+    return PopDelta(handle=handle, pop=session.pop,
+                    entered=[PopQuery(geo_id=k, pop=v) for k, v in entered.items()],
+                    left=left_units)
+
+async def _changed_units(db: DataBase, session: Session, new) -> tuple[dict[str, int], list[str]]:
+    added, removed = await run_geometry(changes, session.geometry, new)
+    bounds = new.bounds
+
+    entered = {}
+    if added is not None:
+        rows = [row for row in await db.get_row_by_geometry(session.cat, added, bounds) if row.geo_id not in session.units]
+        if rows:
+            inside = await db.get_ids_in_geometry(session.cat, new, [row.geo_id for row in rows])
+            entered = {row.geo_id: row.pop or 0 for row in rows if row.geo_id in inside}
+
+    left = []
+    if removed is not None:
+        rows = await db.get_row_by_geometry(session.cat, removed, bounds)
+        candidates = [row.geo_id for row in rows if row.geo_id in session.units]
+        if candidates:
+            remaining = await db.get_ids_in_geometry(session.cat, new, candidates)
+            left = [geo_id for geo_id in candidates if geo_id not in remaining]
+    return entered, left
@@ -0,0 +1,87 @@
+import asyncio
+import os
+import time
+
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable
+
+from shapely.geometry.base import BaseGeometry
+
+# "thread" runs all geometry work on a thread pool; shapely 2 releases the GIL in
+# its vectorized functions, so this scales for most operations. "process" sends
+# the heaviest operations (buffering, topology building) to a process pool.
+EXECUTOR_KIND = os.getenv("MAUSHOLD_GEOMETRY_EXECUTOR", "thread")
+WORKERS = int(os.getenv("MAUSHOLD_GEOMETRY_WORKERS", str(os.cpu_count() or 4)))
+
+_threads: ThreadPoolExecutor | None = None
+_processes: ProcessPoolExecutor | None = None
+
+def get_executor(heavy: bool = False) -> Executor:
+    global _threads, _processes
+    if heavy and EXECUTOR_KIND == "process":
+        if _processes is None:
+            _processes = ProcessPoolExecutor(max_workers=WORKERS)
+        return _processes
+    if _threads is None:
+        _threads = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="geometry")
+    return _threads
+
+async def run_geometry(fn: Callable, *args: Any, heavy: bool = False) -> Any:
+    """Run CPU-bound geometry work off the event loop. Arguments must pickle when `heavy` may use processes."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(heavy), fn, *args)
+
+async def as_shapely(geom):
+    """Shapely geometry for a GeoJSON model, converted on the executor; shapely geometries pass through."""
+    if geom is None or isinstance(geom, BaseGeometry):
+        return geom
+    return await run_geometry(geom.to_shapely)
+
+def shutdown():
+    global _threads, _processes
+    if _threads is not None:
+        _threads.shutdown(wait=False, cancel_futures=True)
+        _threads = None
+    if _processes is not None:
+        _processes.shutdown(wait=False, cancel_futures=True)
+        _processes = None
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop wakes a task that sleeps for `interval`.
+    Anything blocking the loop shows up directly as lag.
+    """
+    def __init__(self, interval: float = 0.1, window: int = 600):
+        self.interval = interval
+        self.window = window
+        self.samples: list[float] = []
+        self.task: asyncio.Task | None = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - start - self.interval)
+            self.samples.append(lag)
+            if len(self.samples) > self.window:
+                del self.samples[0]
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    def stats(self) -> dict[str, float]:
+        """Lag in milliseconds over the last `window` samples."""
+        if not self.samples:
+            return {"current": 0.0, "mean": 0.0, "p99": 0.0, "max": 0.0}
+        ordered = sorted(self.samples)
+        return {
+            "current": self.samples[-1] * 1000,
+            "mean": sum(ordered) / len(ordered) * 1000,
+            "p99": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+            "max": ordered[-1] * 1000,
+        }
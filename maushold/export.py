@@ -0,0 +1,17 @@
+from pathlib import Path
+
+from .models import CensusCategory
+
+EXPORT_DIR = Path("./data/export")
+
+EXPORT_FORMATS = {
+    "fgb": "application/flatgeobuf",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+def export_path(name: str) -> tuple[Path, str]:
+    """Path and media type of an export such as `block.fgb`. Raises ValueError for names that are not one."""
+    cat, _, ext = name.partition(".")
+    if ext not in EXPORT_FORMATS:
+        raise ValueError(name)
+    return EXPORT_DIR / f"{CensusCategory(cat).value}.{ext}", EXPORT_FORMATS[ext]
@@ -0,0 +1,61 @@
+import aiofiles
+
+from pathlib import Path
+
+from fastapi import Request
+from starlette.responses import FileResponse, Response, StreamingResponse
+
+CHUNK_SIZE = 256 * 1024
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """
+    Inclusive byte range of a single-range Range header. Returns None for headers
+    that should be ignored (other units or several ranges) and raises ValueError
+    when the range cannot be satisfied.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    if first == "":
+        if last == "":
+            raise ValueError(header)
+        length = int(last)
+        if length == 0:
+            raise ValueError(header)
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = int(last) if last != "" else size - 1
+    if start >= size or end < start:
+        raise ValueError(header)
+    return start, min(end, size - 1)
+
+async def read_range(path: Path, start: int, end: int):
+    async with aiofiles.open(path, "rb") as f:
+        await f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def file_response(request: Request, path: Path, media_type: str, filename: str | None = None) -> Response:
+    """Serve a file, honouring a single byte range so clients can resume or read pieces of it."""
+    size = path.stat().st_size
+    # Byte ranges refer to the file as stored, so keep GZipMiddleware off these responses.
+    headers = {"Accept-Ranges": "bytes", "Content-Encoding": "identity"}
+    if filename is not None:
+        headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    header = request.headers.get("Range")
+    try:
+        byte_range = parse_range(header, size) if header is not None else None
+    except ValueError:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    if byte_range is None:
+        return FileResponse(path, media_type=media_type, headers=headers)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(read_range(path, start, end), status_code=206, media_type=media_type, headers=headers)
@@ -0,0 +1,102 @@
+import math
+
+import numpy as np
+import shapely
+
+from .db import DataBase
+from .executor import run_geometry
+
+# Web mercator tile levels of the population pyramid. Level 4 tiles are ~2500km
+# wide, level 14 tiles ~2.4km at the equator.
+MIN_LEVEL = 4
+MAX_LEVEL = 14
+LEVELS = range(MIN_LEVEL, MAX_LEVEL + 1)
+
+# Upper bound on boundary cells refined per level before settling for an estimate.
+MAX_CELLS = 20_000
+
+MAX_LAT = 85.05112878
+
+def tile_xy(lon: np.ndarray, lat: np.ndarray, z: int) -> tuple[np.ndarray, np.ndarray]:
+    """Tile column/row at level `z` for arrays of lon/lat degrees."""
+    n = 2 ** z
+    lat = np.radians(np.clip(lat, -MAX_LAT, MAX_LAT))
+    x = np.floor((np.asarray(lon) + 180.0) / 360.0 * n)
+    y = np.floor((1.0 - np.arcsinh(np.tan(lat)) / np.pi) / 2.0 * n)
+    return np.clip(x, 0, n - 1).astype(np.int64), np.clip(y, 0, n - 1).astype(np.int64)
+
+def tile_bounds(x: np.ndarray, y: np.ndarray, z: int) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    n = 2 ** z
+    minX = x / n * 360.0 - 180.0
+    maxX = (x + 1) / n * 360.0 - 180.0
+    maxY = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y / n))))
+    minY = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + 1) / n))))
+    return minX, minY, maxX, maxY
+
+def start_level(bounds: tuple[float, float, float, float]) -> int:
+    """Coarsest level at which the bbox spans at most a couple of tiles."""
+    width = max(bounds[2] - bounds[0], bounds[3] - bounds[1])
+    if width <= 0:
+        return MAX_LEVEL
+    z = math.floor(math.log2(360.0 / width))
+    return min(max(z, MIN_LEVEL), MAX_LEVEL)
+
+def covering_tiles(bounds: tuple[float, float, float, float], z: int) -> list[tuple[int, int]]:
+    minX, minY, maxX, maxY = bounds
+    x0, y1 = tile_xy(np.array([minX]), np.array([minY]), z)
+    x1, y0 = tile_xy(np.array([maxX]), np.array([maxY]), z)
+    return [(x, y) for x in range(int(x0[0]), int(x1[0]) + 1) for y in range(int(y0[0]), int(y1[0]) + 1)]
+
+def children(tiles: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    return [(2 * x + dx, 2 * y + dy) for x, y in tiles for dx in (0, 1) for dy in (0, 1)]
+
+def classify(geom, tiles: list[tuple[int, int]], pops: np.ndarray, z: int, final: bool) -> tuple[float, float, list[tuple[int, int]]]:
+    """
+    Population of the tiles covered by `geom` and the boundary tiles left to refine.
+    When `final` the boundary tiles are weighted by their area inside instead,
+    and the second value is the bound on the error that adds.
+    """
+    xs = np.array([t[0] for t in tiles])
+    ys = np.array([t[1] for t in tiles])
+    boxes = shapely.box(*tile_bounds(xs, ys, z))
+    covered = shapely.contains(geom, boxes)
+    boundary = shapely.intersects(geom, boxes) & ~covered
+    total = pops[covered].sum()
+    if not final and int(boundary.sum()) * 4 <= MAX_CELLS:
+        return total, 0.0, [t for t, b in zip(tiles, boundary) if b]
+    inside = shapely.area(shapely.intersection(geom, boxes[boundary]))
+    frac = np.clip(inside / shapely.area(boxes[boundary]), 0.0, 1.0)
+    total += (frac * pops[boundary]).sum()
+    error = (np.maximum(frac, 1.0 - frac) * pops[boundary]).sum()
+    return total, error, []
+
+async def approximate_pop(db: DataBase, geom) -> tuple[int, int]:
+    """
+    Estimate the population inside `geom` from the grid pyramid. Cells fully
+    inside the geometry are summed at the coarsest level that fits, cells on the
+    boundary are refined down to MAX_LEVEL and finally weighted by the fraction
+    of their area inside the geometry.
+
+    Returns the estimate and a bound on its absolute error.
+    """
+    if geom is None or geom.is_empty:
+        return 0, 0
+    shapely.prepare(geom)
+    z = start_level(geom.bounds)
+    tiles = covering_tiles(geom.bounds, z)
+    total = 0.0
+    error = 0.0
+    while tiles:
+        cells = await db.get_grid_cells(z, tiles)
+        tiles = [t for t in tiles if cells.get(t, 0) > 0]
+        if not tiles:
+            break
+        pops = np.array([cells[t] for t in tiles], dtype=np.float64)
+        covered, bound, tiles = await run_geometry(classify, geom, tiles, pops, z, z >= MAX_LEVEL)
+        total += covered
+        error += bound
+        if not tiles:
+            break
+        tiles = children(tiles)
+        z += 1
+    return int(round(total)), int(math.ceil(error))
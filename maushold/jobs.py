@@ -0,0 +1,205 @@
+import asyncio
+import gzip
+import json
+import logging
+import re
+import time
+import uuid
+
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .admission import Lane
+from .db import ROW_FIELDS, splice_geometry
+from .models import JobFormat, JobInfo, JobRequest, JobStatus
+
+logger = logging.getLogger("maushold.jobs")
+
+JOB_DIR = Path("./data/jobs")
+JOB_ID = re.compile(r"[0-9a-f]{32}")
+
+GEOMETRY_SCHEMA = pa.schema([
+    ("geo_id", pa.string()),
+    ("pop", pa.int64()),
+    ("lon", pa.float64()),
+    ("lat", pa.float64()),
+])
+
+ROW_SCHEMA = pa.schema([
+    ("geo_id", pa.string()),
+    ("clat", pa.float64()),
+    ("clon", pa.float64()),
+    ("area", pa.float64()),
+    ("housing", pa.int64()),
+    ("pop", pa.int64()),
+    ("geometry", pa.string()),
+])
+
+class NdjsonWriter:
+    def __init__(self, path: Path):
+        self.f = gzip.open(path, "wb", compresslevel=6)
+
+    def write(self, rows: list[dict]):
+        lines = []
+        for row in rows:
+            if "geojson" in row:
+                lines.append(splice_geometry({k: row[k] for k in ROW_FIELDS if k in row}, row["geojson"] or "null"))
+            else:
+                lines.append(json.dumps(row, separators=(",", ":")).encode())
+        self.f.write(b"\n".join(lines) + b"\n")
+
+    def close(self):
+        self.f.close()
+
+class ParquetWriter:
+    def __init__(self, path: Path, schema: pa.Schema):
+        self.schema = schema
+        self.writer = pq.ParquetWriter(path, schema, compression="zstd")
+
+    def write(self, rows: list[dict]):
+        if "geojson" in rows[0]:
+            rows = [{**row, "geometry": row["geojson"]} for row in rows]
+        self.writer.write_table(pa.Table.from_pylist(rows, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+def result_path(directory: Path, info: JobInfo) -> Path:
+    suffix = ".ndjson.gz" if info.format == JobFormat.ndjson else ".parquet"
+    return directory / f"{info.id}{suffix}"
+
+class Job:
+    """
+    A job and its files: the result, and its JobInfo as JSON alongside so that
+    every worker process serving the API can report on it.
+    """
+    def __init__(self, info: JobInfo, directory: Path, request: JobRequest | None = None):
+        self.info = info
+        self.request = request
+        self.path = result_path(directory, info)
+        self.meta_path = directory / f"{info.id}.json"
+
+    @classmethod
+    def load(cls, directory: Path, id: str) -> "Job | None":
+        """The job saved under `id` by any process, or None."""
+        if not JOB_ID.fullmatch(id):
+            return None
+        try:
+            return cls(JobInfo.parse_file(directory / f"{id}.json"), directory)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self):
+        # Unique per call, since a save from another thread may be in flight.
+        tmp = self.meta_path.with_name(f"{self.info.id}.{uuid.uuid4().hex}.tmp")
+        tmp.write_text(self.info.json())
+        tmp.replace(self.meta_path)
+
+    def writer(self):
+        if self.request.format == JobFormat.parquet:
+            return ParquetWriter(self.path, GEOMETRY_SCHEMA if self.request.geometry is not None else ROW_SCHEMA)
+        return NdjsonWriter(self.path)
+
+class JobManager:
+    """
+    Runs large queries in the background, one per slot of `lane`, writing
+    results to disk. Jobs beyond `max_queued` are refused with asyncio.QueueFull.
+    Jobs and their files are deleted `ttl` seconds after they were last updated.
+    """
+    def __init__(self, pool, lane: Lane, max_queued: int = 64, directory: Path = JOB_DIR,
+                 ttl: float = 86400, sweep_interval: float = 3600):
+        self.pool = pool
+        self.lane = lane
+        self.directory = directory
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.queue: asyncio.Queue[Job] = asyncio.Queue(maxsize=max_queued)
+        self.jobs: dict[str, Job] = {}
+        self.tasks: list[asyncio.Task] = []
+
+    async def start(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.tasks = [asyncio.create_task(self._work()) for _ in range(self.lane.concurrency)]
+        self.tasks.append(asyncio.create_task(self._sweep_forever()))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def submit(self, request: JobRequest) -> JobInfo:
+        job = Job(JobInfo(id=uuid.uuid4().hex, status=JobStatus.queued, format=request.format), self.directory, request)
+        # Saved before it is queued, so a worker's later saves cannot be overwritten by this one.
+        await asyncio.to_thread(job.save)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            job.meta_path.unlink(missing_ok=True)
+            raise
+        self.jobs[job.info.id] = job
+        return job.info
+
+    async def get(self, id: str) -> Job | None:
+        """Jobs submitted here are kept in memory; others are read from their metadata."""
+        job = self.jobs.get(id)
+        if job is None:
+            job = await asyncio.to_thread(Job.load, self.directory, id)
+        return job
+
+    async def _work(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self._run(job)
+            except Exception as e:
+                logger.exception("job %s failed", job.info.id)
+                job.info.status = JobStatus.failed
+                job.info.error = getattr(e, "detail", None) or str(e)
+                job.path.unlink(missing_ok=True)
+                await asyncio.to_thread(job.save)
+            finally:
+                self.queue.task_done()
+
+    async def _run(self, job: Job):
+        job.info.status = JobStatus.running
+        await asyncio.to_thread(job.save)
+        request = job.request
+        writer = await asyncio.to_thread(job.writer)
+        try:
+            async with self.lane.admit(), self.pool.connection(self.lane.timeout) as db:
+                async for rows in db.stream_rows(request.cat, request.geometry, request.id):
+                    await asyncio.to_thread(writer.write, rows)
+                    job.info.rows += len(rows)
+                    await asyncio.to_thread(job.save)
+        finally:
+            await asyncio.to_thread(writer.close)
+        job.info.bytes = job.path.stat().st_size
+        job.info.status = JobStatus.done
+        await asyncio.to_thread(job.save)
+
+    def sweep(self):
+        """Delete job files not modified for `ttl` seconds, except those of jobs still queued or running here."""
+        active = {job.info.id for job in self.jobs.values() if job.info.status in (JobStatus.queued, JobStatus.running)}
+        cutoff = time.time() - self.ttl
+        for path in self.directory.iterdir():
+            if path.name.split(".", 1)[0] in active:
+                continue
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+            except FileNotFoundError:
+                # Another process swept it first.
+                pass
+        for id, job in list(self.jobs.items()):
+            if id not in active and not job.meta_path.exists():
+                del self.jobs[id]
+
+    async def _sweep_forever(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep)
+            except OSError:
+                logger.exception("job sweep failed")
+            await asyncio.sleep(self.sweep_interval)
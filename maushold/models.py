@@ -1,7 +1,7 @@
 import shapely
 
 from enum import Enum
-from pydantic import BaseModel
+from pydantic import BaseModel, confloat
 from shapely.geometry import shape
 from typing import Any, Optional
 
@@ -18,12 +18,23 @@ class DbRow(BaseModel):
     housing: int
     pop: int
 
+class IdPage(BaseModel):
+    ids: list[str]
+    next: Optional[str] = None
+
 class PopQuery(BaseModel):
     geo_id: str
     pop: int
 
 class PopTotal(BaseModel):
     pop: int
+    error: Optional[int] = None
+
+class PopDelta(BaseModel):
+    handle: str
+    pop: int
+    entered: list[PopQuery]
+    left: list[PopQuery]
 
 class GeoRefPopQuery(BaseModel):
     geo_id: str 
@@ -31,6 +42,29 @@ class GeoRefPopQuery(BaseModel):
     lon: float
     lat: float
 
+class Unit(str, Enum):
+    meters     = 'm'
+    miles      = 'mi'
+    kilometers = 'km'
+    ft         = 'ft'
+
+class RadiusPoint(BaseModel):
+    lat: confloat(ge=-90, le=90) #type: ignore
+    lon: confloat(ge=-180, le=180) #type: ignore
+    radius: confloat(ge=0) #type: ignore
+
+class RadiusQuery(BaseModel):
+    points: list[RadiusPoint]
+    unit: Unit = Unit.miles
+    ids: bool = False
+
+class RadiusPopTotal(BaseModel):
+    lat: float
+    lon: float
+    radius: float
+    pop: int
+    ids: Optional[list[str]] = None
+
 class GeometryType(str, Enum):
     Point = "Point"
     LineString = "LineString"
@@ -61,6 +95,10 @@ class GeometryCollection(BaseModel):
     type: str = "FeatureCollection"
     features: list[Feature]
 
+class GeometryFormat(str, Enum):
+    geojson  = 'geojson'
+    topojson = 'topojson'
+
 class CensusCategory(str, Enum):
     state       = 'state'
     county      = 'county'
@@ -111,15 +149,33 @@ class Polygon(BaseModel):
         poly = shapely.Polygon(self.coordinates[0])
         return shapely.contains(poly, shapely.Point(x,y))
             
-class Unit(str, Enum):
-    meters     = 'm'
-    miles      = 'mi'
-    kilometers = 'km'
-    ft         = 'ft'
-
 conversion_to_m = {
     'm': 1,
     'mi': 1609.344,
     'km': 1000,
     'ft': 0.3048
 }
+
+class JobFormat(str, Enum):
+    ndjson  = 'ndjson'
+    parquet = 'parquet'
+
+class JobStatus(str, Enum):
+    queued  = 'queued'
+    running = 'running'
+    done    = 'done'
+    failed  = 'failed'
+
+class JobRequest(BaseModel):
+    cat: CensusCategory
+    geometry: Optional[GeoJSON] = None
+    id: Optional[str] = None
+    format: JobFormat = JobFormat.ndjson
+
+class JobInfo(BaseModel):
+    id: str
+    status: JobStatus
+    format: JobFormat
+    rows: int = 0
+    bytes: int = 0
+    error: Optional[str] = None
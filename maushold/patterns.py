@@ -0,0 +1,46 @@
+from enum import Enum
+
+# Trigram indexes can only narrow a search on a literal run at least this long.
+MIN_TRIGRAM = 3
+
+class PatternKind(str, Enum):
+    exact = "exact"
+    prefix = "prefix"
+    suffix = "suffix"
+    infix = "infix"
+    scan = "scan"
+
+class IdPattern:
+    """
+    An id pattern using '*' wildcards, classified by the index best placed to
+    answer it: the geo_id btree for exact and prefix matches, the reversed-id
+    index for suffix matches and the trigram index for anything else with a
+    long enough literal run. Ties go to the btree, then the reversed index.
+    """
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        parts = pattern.split("*")
+        prefix, suffix = len(parts[0]), len(parts[-1])
+        infix = max(len(part) for part in parts)
+        if len(parts) == 1:
+            self.kind = PatternKind.exact
+        elif prefix and prefix >= suffix and prefix >= infix:
+            self.kind = PatternKind.prefix
+        elif suffix and suffix >= infix:
+            self.kind = PatternKind.suffix
+        elif infix >= MIN_TRIGRAM:
+            self.kind = PatternKind.infix
+        elif prefix:
+            self.kind = PatternKind.prefix
+        elif suffix:
+            self.kind = PatternKind.suffix
+        else:
+            self.kind = PatternKind.scan
+
+    @property
+    def reversed(self) -> str:
+        """The pattern matching reversed ids; matches exactly the ids the pattern does."""
+        return self.pattern[::-1]
+
+    def like(self, pattern: str | None = None) -> str:
+        return (self.pattern if pattern is None else pattern).replace("*", "%")
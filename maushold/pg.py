@@ -2,10 +2,14 @@ from __future__ import annotations
 
 from shapely.geometry.base import shapely
 
-from .db import DataBase
-from .models import DbRow, PopQuery, CensusCategory, GeoRefPopQuery, GeoJSON
+from .db import ROW_FIELDS, ROW_PAGE_SIZE, DataBase, splice_geometry
+from .executor import as_shapely, run_geometry
+from .models import DbRow, IdPage, PopQuery, CensusCategory, GeoRefPopQuery, GeoJSON
+from .patterns import IdPattern, PatternKind
+from .shards import get_router, states_for_id
 from contextlib import asynccontextmanager
 from psycopg import AsyncConnection
+from psycopg.errors import QueryCanceled
 from psycopg_pool import AsyncConnectionPool
 from psycopg.rows import class_row, dict_row
 from psycopg.types import TypeInfo
@@ -14,6 +18,16 @@ from shapely.geometry import mapping
 
 
 
+def to_rows(res: list[dict]) -> list[DbRow]:
+    data = []
+    for row in res:
+        row['geometry'] = mapping(row['geog'])
+        data.append(DbRow(**row)) #type: ignore
+    return data
+
+def to_geojson(geoms: list) -> list[GeoJSON]:
+    return [GeoJSON(**mapping(geom)) for geom in geoms]
+
 async def register_types(conn: AsyncConnection):
     info = await TypeInfo.fetch(conn, "geometry")
     if info is not None:
@@ -24,17 +38,18 @@ class PgConnector:
         self.pool = AsyncConnectionPool(*args, **kwargs)
 
     @asynccontextmanager
-    async def connection(self):
+    async def connection(self, statement_timeout: float | None = None):
+        conn = await self.pool.getconn()
         try:
-            conn = await self.pool.getconn()
             db = PgDB(conn)
+            if statement_timeout is not None:
+                await db.set_statement_timeout(statement_timeout)
             yield db
             await conn.commit()
-        except:
-            raise ValueError("oops")
+        except QueryCanceled as e:
+            raise TimeoutError("statement timeout") from e
         finally:
-            if db is not None:
-                await self.pool.putconn(db.conn)
+            await self.pool.putconn(conn)
 
         
 
@@ -42,6 +57,10 @@ class PgDB(DataBase):
     def __init__(self, connection: AsyncConnection):
         self.conn = connection
 
+    async def set_statement_timeout(self, seconds: float):
+        """Cancel statements in the current transaction that run longer than `seconds`."""
+        await self.conn.execute(f"SET LOCAL statement_timeout = {int(seconds * 1000)}") #type: ignore
+
     async def get_ids(self, cat: CensusCategory, limit: int = 10_000, offset: int = 0) -> list[str]:
         cur = self.conn.cursor(row_factory=dict_row)
         table = cat.to_table()
@@ -55,31 +74,125 @@ class PgDB(DataBase):
         await cur.close()
         return [row["geo_id"] for row in res]
 
-    async def get_row_data(self, table: str, id: str, offset:int = 0) -> list[DbRow]:
+    async def get_ids_after(self, cat: CensusCategory, after: str, limit: int = 10_000) -> IdPage:
+        """Keyset page of ids: seeks past `after` on the geo_id index instead of counting off rows."""
         cur = self.conn.cursor()
-        await cur.execute(f"SELECT * FROM {table} WHERE geo_id LIKE %s LIMIT 500 offset %s", (id.replace('*','%'), offset)) #type: ignore
+        await cur.execute(f"""SELECT geo_id
+                        FROM {cat.to_table()}
+                        WHERE geo_id > %s
+                        ORDER BY geo_id ASC
+                        LIMIT %s;""", #type: ignore
+                    (after, limit))
+        res = await cur.fetchall()
+        await cur.close()
+        ids = [row[0] for row in res]
+        return IdPage(ids=ids, next=ids[-1] if len(ids) == limit else None)
+
+    async def get_row_data(self, cat: CensusCategory, id: str, offset: int = 0, after: str | None = None) -> list[DbRow]:
+        cur = self.conn.cursor(row_factory=dict_row)
+        table = cat.to_table()
+        where, params = self._id_filter(cat, id)
+        if after is None:
+            await cur.execute(f"SELECT * FROM {table} WHERE {where} ORDER BY geo_id LIMIT %s offset %s", (*params, ROW_PAGE_SIZE, offset)) #type: ignore
+        else:
+            await cur.execute(f"SELECT * FROM {table} WHERE {where} AND geo_id > %s ORDER BY geo_id LIMIT %s", (*params, after, ROW_PAGE_SIZE)) #type: ignore
+        res = await cur.fetchall()
+        await cur.close()
+        return await run_geometry(to_rows, res)
+
+    async def get_row_json(self, cat: CensusCategory, id: str, after: str | None = None) -> list[tuple[str, bytes]]:
+        """Serialized rows with the GeoJSON stored at setup spliced in, so no geometry is decoded."""
+        cur = self.conn.cursor(row_factory=dict_row)
+        where, params = self._id_filter(cat, id)
+        cursor, cursor_params = (" AND geo_id > %s", (after,)) if after is not None else ("", ())
+        await cur.execute(f"""SELECT geo_id,
+                                CAST(clat AS double precision) AS clat,
+                                CAST(clon AS double precision) AS clon,
+                                ST_XMin(geog) AS "minX",
+                                ST_YMin(geog) AS "minY",
+                                ST_XMax(geog) AS "maxX",
+                                ST_YMax(geog) AS "maxY",
+                                ST_Area(geog) AS area,
+                                COALESCE(housing, 0) AS housing,
+                                COALESCE(pop, 0) AS pop,
+                                COALESCE(geojson, ST_AsGeoJSON(geog)) AS geojson
+                             FROM {cat.to_table()}
+                             WHERE {where}{cursor}
+                             ORDER BY geo_id
+                             LIMIT %s""", #type: ignore
+                          (*params, *cursor_params, ROW_PAGE_SIZE))
         res = await cur.fetchall()
         await cur.close()
-        data = []
-        for row in map(lambda x: dict(x), res):
-            row['geometry'] = mapping(row['geog'])
-            data.append(DbRow(**row)) #type: ignore
-        return data
+        return [(row["geo_id"], splice_geometry({k: row[k] for k in ROW_FIELDS}, row["geojson"])) for row in res]
 
     async def get_pop_data(self, cat: CensusCategory, id: str) -> list[PopQuery]:
         cur = self.conn.cursor(row_factory=class_row(PopQuery))
-        await cur.execute(f"SELECT geo_id, pop FROM {cat.to_table()} WHERE geo_id LIKE %s", (id.replace('*', '%'),)) #type: ignore
+        where, params = self._id_filter(cat, id)
+        await cur.execute(f"SELECT geo_id, pop FROM {cat.to_table()} WHERE {where}", params) #type: ignore
+        res = await cur.fetchall()
+        await cur.close()
+        return res
+
+    def _id_filter(self, cat: CensusCategory, id: str) -> tuple[str, tuple]:
+        """
+        Predicate matching an id pattern, written so the planner can use the index
+        that fits its shape: equality and prefix LIKE hit the text_pattern_ops btree,
+        suffixes are matched on reverse(geo_id) and infix LIKE uses the trigram index.
+        """
+        pattern = IdPattern(id)
+        shard, shard_params = self._id_partitions(cat, id)
+        match pattern.kind:
+            case PatternKind.exact:
+                return f"geo_id = %s{shard}", (id, *shard_params)
+            case PatternKind.suffix:
+                return f"reverse(geo_id) LIKE %s{shard}", (pattern.like(pattern.reversed), *shard_params)
+            case _:
+                return f"geo_id LIKE %s{shard}", (pattern.like(), *shard_params)
+
+    def _id_partitions(self, cat: CensusCategory, id: str) -> tuple[str, tuple]:
+        """Extra predicate pinning block lookups to the state partition named by the id prefix."""
+        states = states_for_id(id) if cat == CensusCategory.block else None
+        if states is None:
+            return "", ()
+        return " AND state_fp = ANY(%s)", (states,)
+
+    async def get_state_bounds(self) -> dict[str, tuple[float, float, float, float]]:
+        cur = self.conn.cursor()
+        await cur.execute("SELECT geo_id, ST_XMin(geog), ST_YMin(geog), ST_XMax(geog), ST_YMax(geog) FROM states")
+        res = await cur.fetchall()
+        await cur.close()
+        return {row[0]: (row[1], row[2], row[3], row[4]) for row in res}
+
+    async def get_centroids(self, cat: CensusCategory) -> list[tuple[str, float, float, int]]:
+        cur = self.conn.cursor()
+        await cur.execute(f"""SELECT geo_id,
+                                CAST(clat AS double precision),
+                                CAST(clon AS double precision),
+                                COALESCE(pop, 0)
+                             FROM {cat.to_table()}""") #type: ignore
         res = await cur.fetchall()
         await cur.close()
         return res
 
-    async def get_row_by_geometry(self, cat: CensusCategory, geom: GeoJSON) -> list[GeoRefPopQuery]:
+    async def get_grid_cells(self, z: int, tiles: list[tuple[int, int]]) -> dict[tuple[int, int], int]:
+        cur = self.conn.cursor()
+        await cur.execute("""SELECT x, y, pop
+                             FROM pop_grid
+                             WHERE z = %s
+                             AND (x, y) IN (SELECT * FROM unnest(%s::integer[], %s::integer[]))""",
+                          (z, [t[0] for t in tiles], [t[1] for t in tiles]))
+        res = await cur.fetchall()
+        await cur.close()
+        return {(row[0], row[1]): row[2] for row in res}
+
+    async def get_row_by_geometry(self, cat: CensusCategory, geom: GeoJSON, bounds: tuple[float, float, float, float] | None = None) -> list[GeoRefPopQuery]:
         await register_types(self.conn)
         cur = self.conn.cursor(row_factory=class_row(GeoRefPopQuery))
-        geo = geom.to_shapely()
+        geo = await as_shapely(geom)
         if geo is None:
             return[GeoRefPopQuery(geo_id = "",pop = -1, lon = 0, lat = 0)]
         if cat == CensusCategory.block:
+            states = (await get_router(self)).states_for_geometry(geo)
             await cur.execute(f"""
                                 SELECT geo_id, pop, lon, lat 
                                 FROM (
@@ -91,11 +204,12 @@ class PgDB(DataBase):
                                     INNER JOIN counties
                                     ON blocks.county_id = counties.geo_id
                                     WHERE ST_Intersects(counties.geog, %s)
+                                    AND blocks.state_fp = ANY(%s)
                                     ) AS T
                                 WHERE ST_Intersects(T.geog, %s)
 
                                         """, #type: ignore
-                                    (geo, geo)) 
+                                    (geo, states, geo)) 
         else:
             await cur.execute(f"""
                         SELECT geo_id, pop,
@@ -108,13 +222,63 @@ class PgDB(DataBase):
         await cur.close()
         return res
 
+    async def stream_rows(self, cat: CensusCategory, geom: GeoJSON | None = None, id: str | None = None, batch_size: int = 10_000):
+        """Streams through a server-side cursor so exports never hold the whole result in memory."""
+        table = cat.to_table()
+        if geom is not None:
+            await register_types(self.conn)
+            geo = await as_shapely(geom)
+            shard, shard_params = "", ()
+            if cat == CensusCategory.block:
+                shard, shard_params = " AND state_fp = ANY(%s)", ((await get_router(self)).states_for_geometry(geo),)
+            sql = f"""SELECT geo_id,
+                          COALESCE(pop, 0) AS pop,
+                          CAST(clon AS double precision) AS lon,
+                          CAST(clat AS double precision) AS lat
+                      FROM {table}
+                      WHERE ST_Intersects(geog, %s){shard}"""
+            params = (geo, *shard_params)
+        else:
+            where, params = self._id_filter(cat, id or "*")
+            sql = f"""SELECT geo_id,
+                          CAST(clat AS double precision) AS clat,
+                          CAST(clon AS double precision) AS clon,
+                          ST_Area(geog) AS area,
+                          COALESCE(housing, 0) AS housing,
+                          COALESCE(pop, 0) AS pop,
+                          COALESCE(geojson, ST_AsGeoJSON(geog)) AS geojson
+                      FROM {table}
+                      WHERE {where}
+                      ORDER BY geo_id"""
+        cur = self.conn.cursor(name="maushold_export", row_factory=dict_row)
+        try:
+            await cur.execute(sql, params) #type: ignore
+            while rows := await cur.fetchmany(batch_size):
+                yield rows
+        finally:
+            await cur.close()
+
+    async def get_ids_in_geometry(self, cat: CensusCategory, geom: GeoJSON, ids: list[str]) -> set[str]:
+        """Which of `ids` intersect `geom`; looks the ids up on the geo_id index rather than scanning the geometry."""
+        await register_types(self.conn)
+        cur = self.conn.cursor()
+        await cur.execute(f"""SELECT geo_id
+                              FROM {cat.to_table()}
+                              WHERE geo_id = ANY(%s)
+                              AND ST_Intersects(geog, %s)""", #type: ignore
+                          (ids, await as_shapely(geom)))
+        res = await cur.fetchall()
+        await cur.close()
+        return {row[0] for row in res}
+
     async def get_intersected_geometries(self, cat: CensusCategory, geom: GeoJSON) -> list[GeoJSON]:
         await register_types(self.conn)
         cur = self.conn.cursor()
-        geo = geom.to_shapely()
+        geo = await as_shapely(geom)
         if geo is None:
             return[]
         if cat == CensusCategory.block:
+            states = (await get_router(self)).states_for_geometry(geo)
             await cur.execute(f"""
                                 SELECT geog
                                 FROM (
@@ -124,10 +288,11 @@ class PgDB(DataBase):
                                     INNER JOIN counties
                                     ON blocks.county_id = counties.geo_id
                                     WHERE ST_Intersects(counties.geog, %s)
+                                    AND blocks.state_fp = ANY(%s)
                                     ) AS T
                                 WHERE ST_Intersects(T.geog, %s)
                                 """, #type: ignore
-                                    (geo, geo)) 
+                                    (geo, states, geo)) 
         else:
             await cur.execute(f"""
                         SELECT geog
@@ -136,5 +301,5 @@ class PgDB(DataBase):
                     (geo,)) 
         res = await cur.fetchall()
         await cur.close()
-        return [GeoJSON(**mapping(feat[0])) for feat in res]
+        return await run_geometry(to_geojson, [feat[0] for feat in res])
 
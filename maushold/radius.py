@@ -0,0 +1,97 @@
+import asyncio
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from .db import DataBase
+from .models import CensusCategory, RadiusPoint, RadiusPopTotal, Unit, conversion_to_m
+from .snapshot import Snapshot, get_snapshot
+
+EARTH_RADIUS_M = 6_371_008.8
+
+def to_xyz(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """Project lat/lon degrees onto the unit sphere."""
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+def chord_length(distance_m: np.ndarray) -> np.ndarray:
+    """
+    Straight-line distance through the unit sphere for a great-circle distance.
+    The mapping is monotonic, so a euclidean ball of this radius around a point
+    on the sphere holds exactly the points within `distance_m` by haversine.
+    """
+    angle = np.minimum(np.asarray(distance_m, dtype=np.float64) / EARTH_RADIUS_M, np.pi)
+    return 2 * np.sin(angle / 2)
+
+class CentroidIndex:
+    """
+    KD-tree over unit centroids on the unit sphere. Ids are kept as fixed-width
+    bytes and pops as plain integers, so only the tree itself costs more memory
+    than the snapshot columns it can be built from.
+    """
+    def __init__(self, ids: np.ndarray, lat: np.ndarray, lon: np.ndarray, pop: np.ndarray):
+        self.ids = ids
+        self.pop = pop
+        self.tree = cKDTree(to_xyz(lat, lon))
+
+    @classmethod
+    def from_rows(cls, rows: list[tuple[str, float, float, int]]) -> "CentroidIndex":
+        ids = np.array([row[0].encode() for row in rows], dtype=np.bytes_)
+        lat = np.fromiter((row[1] for row in rows), dtype=np.float64, count=len(rows))
+        lon = np.fromiter((row[2] for row in rows), dtype=np.float64, count=len(rows))
+        pop = np.fromiter((row[3] or 0 for row in rows), dtype=np.int64, count=len(rows))
+        return cls(ids, lat, lon, pop)
+
+    @classmethod
+    def from_snapshot(cls, snapshot: Snapshot) -> "CentroidIndex":
+        """
+        Index over the snapshot's columns; ids and pops stay memory-mapped. Snapshot
+        centroids are float32, good to about a metre at the edge of a radius.
+        """
+        return cls(snapshot.geo_id, snapshot.centroid[:, 1], snapshot.centroid[:, 0], snapshot.pop)
+
+    def query(self, points: list[RadiusPoint], unit: Unit, ids: bool = False) -> list[RadiusPopTotal]:
+        if len(points) == 0:
+            return []
+        lat = np.array([p.lat for p in points], dtype=np.float64)
+        lon = np.array([p.lon for p in points], dtype=np.float64)
+        radius = np.array([p.radius for p in points], dtype=np.float64) * conversion_to_m[unit.value]
+        matches = self.tree.query_ball_point(to_xyz(lat, lon), chord_length(radius))
+        res = []
+        for point, idx in zip(points, matches):
+            idx = np.asarray(idx, dtype=np.intp)
+            res.append(RadiusPopTotal(lat=point.lat, lon=point.lon, radius=point.radius,
+                                      pop=int(self.pop[idx].sum()),
+                                      ids=[id.decode() for id in self.ids[idx]] if ids else None))
+        return res
+
+_indexes: dict[CensusCategory, CentroidIndex] = {}
+_locks: dict[CensusCategory, asyncio.Lock] = {}
+
+def needs_database(cat: CensusCategory) -> bool:
+    """Whether loading the index for `cat` has to read centroids from the database."""
+    return cat not in _indexes and get_snapshot(cat) is None
+
+async def _build(cat: CensusCategory, fn, *args):
+    _indexes[cat] = await asyncio.to_thread(fn, *args)
+
+async def get_index(db: DataBase | None, cat: CensusCategory) -> CentroidIndex:
+    """
+    Centroid index for `cat`, loaded on first use from the snapshot if there is one,
+    else from `db`, and kept in memory. The build is shielded so a request that
+    times out still leaves the index cached for the next one.
+    """
+    if cat in _indexes:
+        return _indexes[cat]
+    lock = _locks.setdefault(cat, asyncio.Lock())
+    async with lock:
+        if cat not in _indexes:
+            snapshot = get_snapshot(cat)
+            if snapshot is not None:
+                await asyncio.shield(_build(cat, CentroidIndex.from_snapshot, snapshot))
+            else:
+                rows = await db.get_centroids(cat)
+                await asyncio.shield(_build(cat, CentroidIndex.from_rows, rows))
+    return _indexes[cat]
@@ -0,0 +1,57 @@
+import asyncio
+import sqlite3
+
+from pathlib import Path
+
+from .db import DataBase
+
+# Per-state SQLite files holding the blocks of one state each, named <state fips>.db.
+SHARD_DIR = Path("./data/states")
+
+def shard_paths(shard_dir: Path = SHARD_DIR) -> list[Path]:
+    """Per-state block databases in state order, which is also geo_id order."""
+    return sorted(shard_dir.glob("*.db"))
+
+def sources(conn: sqlite3.Connection, table: str) -> list[sqlite3.Connection]:
+    """Databases holding `table`, the per-state shards when blocks were split out of census.db."""
+    shards = shard_paths()
+    if table == "blocks" and shards:
+        return [sqlite3.connect(path) for path in shards]
+    return [conn]
+
+class StateRouter:
+    """
+    Maps queries onto the 2-digit state FIPS codes that can answer them, so that
+    block queries only touch the matching partitions or per-state files.
+    """
+    def __init__(self, bounds: dict[str, tuple[float, float, float, float]]):
+        self.bounds = bounds
+
+    def states_for_bounds(self, bounds: tuple[float, float, float, float]) -> list[str]:
+        minX, minY, maxX, maxY = bounds
+        return sorted(fp for fp, (sMinX, sMinY, sMaxX, sMaxY) in self.bounds.items()
+                      if sMinX <= maxX and sMaxX >= minX and sMinY <= maxY and sMaxY >= minY)
+
+    def states_for_geometry(self, geom) -> list[str]:
+        if geom is None or geom.is_empty:
+            return []
+        return self.states_for_bounds(geom.bounds)
+
+def states_for_id(id: str) -> list[str] | None:
+    """States an id pattern can match, or None when the pattern leaves the state open."""
+    prefix = id.split("*", 1)[0]
+    if len(prefix) < 2:
+        return None
+    return [prefix[:2]]
+
+_router: StateRouter | None = None
+_lock = asyncio.Lock()
+
+async def get_router(db: DataBase) -> StateRouter:
+    global _router
+    if _router is not None:
+        return _router
+    async with _lock:
+        if _router is None:
+            _router = StateRouter(await db.get_state_bounds())
+    return _router
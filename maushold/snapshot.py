@@ -0,0 +1,85 @@
+from fnmatch import fnmatchcase
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import shapely
+
+from .models import CensusCategory, IdPage, PopQuery
+
+SNAPSHOT_DIR = Path("./data/snapshot")
+
+class Snapshot:
+    """
+    Read-only columnar copy of one census table written by snapshot_setup.py.
+    Every column is memory-mapped, so all workers on a host share the same
+    page-cache copy and opening a snapshot costs no more than a few syscalls.
+    Rows are sorted by geo_id.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self.geo_id = np.load(path / "geo_id.npy", mmap_mode="r")
+        self.centroid = np.load(path / "centroid.npy", mmap_mode="r")
+        self.bbox = np.load(path / "bbox.npy", mmap_mode="r")
+        self.pop = np.load(path / "pop.npy", mmap_mode="r")
+        self.housing = np.load(path / "housing.npy", mmap_mode="r")
+        self.wkb_offsets = np.load(path / "wkb_offsets.npy", mmap_mode="r")
+        self.wkb = np.memmap(path / "wkb.bin", dtype=np.uint8, mode="r")
+
+    def __len__(self) -> int:
+        return len(self.geo_id)
+
+    def prefix_range(self, prefix: str) -> tuple[int, int]:
+        """Half-open row range whose ids start with `prefix`."""
+        lo = np.searchsorted(self.geo_id, prefix.encode(), side="left")
+        hi = np.searchsorted(self.geo_id, prefix.encode() + b"\xff", side="left")
+        return int(lo), int(hi)
+
+    def find(self, id: str) -> np.ndarray:
+        """Row indices matching `id`, where '*' matches any run of characters."""
+        if "*" not in id:
+            i = int(np.searchsorted(self.geo_id, id.encode()))
+            if i < len(self) and self.geo_id[i] == id.encode():
+                return np.array([i], dtype=np.intp)
+            return np.array([], dtype=np.intp)
+        prefix = id.split("*", 1)[0]
+        lo, hi = self.prefix_range(prefix)
+        if id == prefix + "*":
+            return np.arange(lo, hi, dtype=np.intp)
+        ids = self.geo_id[lo:hi]
+        hits = [i for i, geo_id in enumerate(ids) if fnmatchcase(geo_id.decode(), id)]
+        return np.array(hits, dtype=np.intp) + lo
+
+    def ids(self, offset: int, limit: int) -> list[str]:
+        return [geo_id.decode() for geo_id in self.geo_id[offset:offset + limit]]
+
+    def ids_after(self, after: str, limit: int) -> IdPage:
+        """Keyset page of ids, matching DataBase.get_ids_after."""
+        lo = int(np.searchsorted(self.geo_id, after.encode(), side="right"))
+        ids = self.ids(lo, limit)
+        return IdPage(ids=ids, next=ids[-1] if len(ids) == limit else None)
+
+    def in_bbox(self, minX: float, minY: float, maxX: float, maxY: float) -> np.ndarray:
+        """Row indices whose bounding box intersects the given one."""
+        bbox = self.bbox
+        mask = (bbox[:, 0] <= maxX) & (bbox[:, 2] >= minX) & (bbox[:, 1] <= maxY) & (bbox[:, 3] >= minY)
+        return np.flatnonzero(mask)
+
+    def wkb_bytes(self, i: int) -> bytes:
+        return self.wkb[self.wkb_offsets[i]:self.wkb_offsets[i + 1]].tobytes()
+
+    def geometry(self, i: int):
+        return shapely.from_wkb(self.wkb_bytes(i))
+
+    def pop_data(self, idx: np.ndarray) -> list[PopQuery]:
+        return [PopQuery(geo_id=self.geo_id[i].decode(), pop=int(self.pop[i])) for i in idx]
+
+@lru_cache(maxsize=None)
+def open_snapshot(cat: CensusCategory, root: Path = SNAPSHOT_DIR) -> Snapshot:
+    return Snapshot(root / cat.to_table())
+
+def get_snapshot(cat: CensusCategory, root: Path = SNAPSHOT_DIR) -> Snapshot | None:
+    """Snapshot of `cat` if snapshot_setup.py has written one, else None so callers use the database."""
+    if not (root / cat.to_table() / "wkb.bin").is_file():
+        return None
+    return open_snapshot(cat, root)
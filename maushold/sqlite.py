@@ -1,63 +1,269 @@
 from __future__ import annotations
 import json
+import time
 import aiosqlite as sqlite3
 
-from .db import DataBase
-from .models import CensusCategory, DbRow, GeoJSON, PopQuery, GeoRefPopQuery
+from .db import ROW_FIELDS, ROW_PAGE_SIZE, DataBase, splice_geometry
+from .executor import as_shapely, run_geometry
+from .models import CensusCategory, DbRow, GeoJSON, IdPage, PopQuery, GeoRefPopQuery
+from .patterns import IdPattern, PatternKind
+from .shards import get_router, states_for_id
 from contextlib import asynccontextmanager
 from pathlib import Path
+from shapely.geometry import mapping
 from shapely.geometry.base import shapely
 
+def to_rows(res: list) -> list[DbRow]:
+    data = []
+    for row in map(lambda x: dict(x), res):
+        row['geometry'] = mapping(shapely.from_wkb(row['geometry']))
+        data.append(DbRow(**row)) #type: ignore
+    return data
+
+def stored_geojson(row) -> str:
+    """GeoJSON stored at setup, or the WKB geometry encoded for rows whose GeoJSON is NULL."""
+    if row["geojson"] is not None:
+        return row["geojson"]
+    if row["wkb"] is None:
+        return "null"
+    return json.dumps(mapping(shapely.from_wkb(row["wkb"])), separators=(",", ":"))
+
+def centroids_inside(geometry, rows: list[GeoRefPopQuery]) -> list[GeoRefPopQuery]:
+    hits = shapely.contains_xy(geometry, [row.lon for row in rows], [row.lat for row in rows])
+    return [row for row, hit in zip(rows, hits) if hit]
+
 async def get_connection() -> sqlite3.Connection:
     conn = await sqlite3.connect("file:./data/census.db?mode=ro&cache=shared&journal_mode=off&sync=off", uri=True)
     conn.row_factory = sqlite3.Row
     return conn
 
 class Sqlite3Connector:
-    def __init__(self, db_path: str | Path, **kwargs):
+    def __init__(self, db_path: str | Path, shard_dir: str | Path | None = None, **kwargs):
         self.path = db_path
+        self.shard_dir = Path(shard_dir) if shard_dir is not None else None
         self.kwargs = kwargs
     
     @asynccontextmanager
-    async def connection(self):
+    async def connection(self, statement_timeout: float | None = None):
         try:
             conn = await sqlite3.connect(self.path, **self.kwargs)
             conn.row_factory = sqlite3.Row
-            db = SqliteDB(conn)
+            db = SqliteDB(conn, self.shard_dir)
+            if statement_timeout is not None:
+                await db.set_statement_timeout(statement_timeout)
             yield db
+        except sqlite3.OperationalError as e:
+            if str(e) == "interrupted":
+                raise TimeoutError("statement timeout") from e
+            raise
         finally:
             print("sqlite")
             await db.conn.close()
 
 class SqliteDB(DataBase):
-    def __init__(self, conn: sqlite3.Connection) -> None:
+    selects_by_bbox = True
+
+    def __init__(self, conn: sqlite3.Connection, shard_dir: Path | None = None) -> None:
         self.conn = conn
+        self.shard_dir = shard_dir
+        self.deadline: float | None = None
+
+    @asynccontextmanager
+    async def _connections(self, cat: CensusCategory, states: list[str] | None = None):
+        """
+        Connections holding `cat`, in geo_id order. Blocks live in one file per state
+        when the database is sharded, and only the files for `states` are opened.
+        """
+        if cat != CensusCategory.block or self.shard_dir is None:
+            yield [self.conn]
+            return
+        if states is None:
+            states = sorted(path.stem for path in self.shard_dir.glob("*.db"))
+        conns = []
+        try:
+            for fp in sorted(states):
+                path = self.shard_dir / f"{fp}.db"
+                if not path.exists():
+                    continue
+                conn = await sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+                conn.row_factory = sqlite3.Row
+                conns.append(conn)
+                if self.deadline is not None:
+                    await self._interrupt_after_deadline(conn)
+            yield conns
+        finally:
+            for conn in conns:
+                await conn.close()
+
+    async def _fetch_ordered(self, conns: list[sqlite3.Connection], sql: str, params: tuple, limit: int, offset: int = 0) -> list[sqlite3.Row]:
+        """Run a query ordered by geo_id over `conns` as if they held one table."""
+        rows = []
+        for conn in conns:
+            if len(rows) >= limit:
+                break
+            cur = await conn.execute(f"{sql} LIMIT ? OFFSET ?", (*params, limit - len(rows), offset))
+            batch = await cur.fetchall()
+            await cur.close()
+            if offset and not batch:
+                cur = await conn.execute(f"SELECT COUNT(*) FROM ({sql})", params)
+                (count,) = await cur.fetchone() #type: ignore
+                await cur.close()
+                offset = max(0, offset - count)
+            else:
+                offset = 0
+            rows.extend(batch)
+        return rows
+
+    async def set_statement_timeout(self, seconds: float):
+        """Interrupt any statement, on this connection or a shard opened later, still running `seconds` from now."""
+        self.deadline = time.monotonic() + seconds
+        await self._interrupt_after_deadline(self.conn)
+
+    async def _interrupt_after_deadline(self, conn: sqlite3.Connection):
+        deadline = self.deadline
+        await conn.set_progress_handler(lambda: time.monotonic() > deadline, 10_000)
 
     async def get_ids(self, cat: CensusCategory, limit: int = 10_000, offset: int = 0) -> list[str]:
-        cur = await self.conn.cursor()
-        await cur.execute(f"SELECT geo_id FROM {cat.to_table()} LIMIT ? OFFSET ?;", (limit, offset))
-        res = await cur.fetchall()
-        await cur.close()
+        async with self._connections(cat) as conns:
+            res = await self._fetch_ordered(conns, f"SELECT geo_id FROM {cat.to_table()} ORDER BY geo_id", (), limit, offset)
         return [row["geo_id"] for row in res]
 
-    async def get_row_data(self, cat: CensusCategory, id: str, offset:int = 0) -> list[DbRow]:
-        cur = await self.conn.cursor()
-        await cur.execute(f"SELECT * FROM {cat.to_table()} WHERE geo_id GLOB ? LIMIT 500 offset ?", (id, offset))
-        res = await cur.fetchall()
-        await cur.close()
-        data = []
-        for row in map(lambda x: dict(x), res):
-            row['geometry'] = json.loads(row['geometry'])
-            data.append(DbRow(**row)) #type: ignore
-        return data
+    async def get_ids_after(self, cat: CensusCategory, after: str, limit: int = 10_000) -> IdPage:
+        """Keyset page of ids: seeks past `after` on the geo_id index instead of counting off rows."""
+        states = None
+        if cat == CensusCategory.block and self.shard_dir is not None:
+            states = [path.stem for path in self.shard_dir.glob("*.db") if path.stem >= after[:2]]
+        async with self._connections(cat, states) as conns:
+            res = await self._fetch_ordered(conns, f"SELECT geo_id FROM {cat.to_table()} WHERE geo_id > ? ORDER BY geo_id", (after,), limit)
+        ids = [row["geo_id"] for row in res]
+        return IdPage(ids=ids, next=ids[-1] if len(ids) == limit else None)
+
+    def _id_filter(self, table: str, id: str) -> tuple[str, tuple]:
+        """
+        Predicate matching an id pattern on the index that fits its shape: equality
+        and prefix GLOB use the geo_id index, suffixes the reversed rev_id column and
+        infixes the FTS5 trigram table built alongside each table.
+        """
+        pattern = IdPattern(id)
+        match pattern.kind:
+            case PatternKind.exact:
+                return "geo_id = ?", (id,)
+            case PatternKind.suffix:
+                return "rev_id GLOB ?", (pattern.reversed,)
+            case PatternKind.infix:
+                return f'rowid IN (SELECT rowid FROM "{table}_trigram" WHERE geo_id GLOB ?)', (id,)
+            case _:
+                return "geo_id GLOB ?", (id,)
+
+    async def get_row_data(self, cat: CensusCategory, id: str, offset: int = 0, after: str | None = None) -> list[DbRow]:
+        table = cat.to_table()
+        where, params = self._id_filter(table, id)
+        async with self._connections(cat, states_for_id(id)) as conns:
+            if after is None:
+                res = await self._fetch_ordered(conns, f"SELECT * FROM {table} WHERE {where} ORDER BY geo_id", params, ROW_PAGE_SIZE, offset)
+            else:
+                res = await self._fetch_ordered(conns, f"SELECT * FROM {table} WHERE {where} AND geo_id > ? ORDER BY geo_id", (*params, after), ROW_PAGE_SIZE)
+        return await run_geometry(to_rows, res)
+
+    async def get_row_json(self, cat: CensusCategory, id: str, after: str | None = None) -> list[tuple[str, bytes]]:
+        """Serialized rows with the GeoJSON stored at setup spliced in, so no geometry is decoded."""
+        where, params = self._id_filter(cat.to_table(), id)
+        cursor, cursor_params = (" AND geo_id > ?", (after,)) if after is not None else ("", ())
+        sql = f"""SELECT geo_id, clat, clon, minX, minY, maxX, maxY, area,
+                         COALESCE(housing, 0) AS housing,
+                         COALESCE(pop, 0) AS pop,
+                         geojson,
+                         CASE WHEN geojson IS NULL THEN geometry END AS wkb
+                  FROM {cat.to_table()}
+                  WHERE {where}{cursor}
+                  ORDER BY geo_id"""
+        async with self._connections(cat, states_for_id(id)) as conns:
+            res = await self._fetch_ordered(conns, sql, (*params, *cursor_params), ROW_PAGE_SIZE)
+        return [(row["geo_id"], splice_geometry({k: row[k] for k in ROW_FIELDS}, stored_geojson(row))) for row in res]
 
     async def get_pop_data(self, cat: CensusCategory, id: str) -> list[PopQuery]:
-        cur = await self.conn.execute(f"SELECT geo_id, pop FROM {cat.to_table()} WHERE geo_id GLOB ?", (id,))
+        res = []
+        where, params = self._id_filter(cat.to_table(), id)
+        async with self._connections(cat, states_for_id(id)) as conns:
+            for conn in conns:
+                cur = await conn.execute(f"SELECT geo_id, pop FROM {cat.to_table()} WHERE {where}", params)
+                res.extend(await cur.fetchall())
+                await cur.close()
+        return [PopQuery.parse_obj(row) for row in res]
+
+    async def stream_rows(self, cat: CensusCategory, geom: GeoJSON | None = None, id: str | None = None, batch_size: int = 10_000):
+        if geom is not None:
+            rows = await self.get_row_by_polygon(cat, geom)
+            for i in range(0, len(rows), batch_size):
+                yield [row.dict() for row in rows[i:i + batch_size]]
+            return
+        id = id or "*"
+        where, params = self._id_filter(cat.to_table(), id)
+        async with self._connections(cat, states_for_id(id)) as conns:
+            for conn in conns:
+                cur = await conn.execute(f"""SELECT geo_id, clat, clon, area,
+                                                    COALESCE(housing, 0) AS housing,
+                                                    COALESCE(pop, 0) AS pop,
+                                                    geojson,
+                                                    CASE WHEN geojson IS NULL THEN geometry END AS wkb
+                                             FROM {cat.to_table()}
+                                             WHERE {where}
+                                             ORDER BY geo_id""", params)
+                try:
+                    while rows := await cur.fetchmany(batch_size):
+                        yield [{k: row[k] for k in row.keys() if k != "wkb"} | {"geojson": stored_geojson(row)} for row in rows]
+                finally:
+                    await cur.close()
+
+    async def get_ids_in_geometry(self, cat: CensusCategory, geom: GeoJSON, ids: list[str]) -> set[str]:
+        """Which of `ids` have their centroid inside `geom`, matching get_row_by_polygon."""
+        rows = []
+        chunk = 500
+        states = sorted({geo_id[:2] for geo_id in ids})
+        async with self._connections(cat, states) as conns:
+            for conn in conns:
+                for i in range(0, len(ids), chunk):
+                    batch = ids[i:i + chunk]
+                    cur = await conn.execute(f"SELECT geo_id, clon, clat FROM {cat.to_table()} WHERE geo_id IN ({','.join('?' * len(batch))})", batch)
+                    rows.extend(await cur.fetchall())
+                    await cur.close()
+        if not rows:
+            return set()
+        hits = await run_geometry(shapely.contains_xy, await as_shapely(geom), [row[1] for row in rows], [row[2] for row in rows])
+        return {row[0] for row, hit in zip(rows, hits) if hit}
+
+    async def get_state_bounds(self) -> dict[str, tuple[float, float, float, float]]:
+        cur = await self.conn.execute("SELECT geo_id, minX, minY, maxX, maxY FROM states")
         res = await cur.fetchall()
         await cur.close()
-        return [PopQuery.parse_obj(row) for row in res]
+        return {row[0]: (row[1], row[2], row[3], row[4]) for row in res}
 
-    async def get_row_by_polygon(self, cat: CensusCategory, geom: GeoJSON) -> list[GeoRefPopQuery]:
+    async def get_centroids(self, cat: CensusCategory) -> list[tuple[str, float, float, int]]:
+        res = []
+        async with self._connections(cat) as conns:
+            for conn in conns:
+                cur = await conn.execute(f"SELECT geo_id, clat, clon, COALESCE(pop, 0) FROM {cat.to_table()}")
+                res.extend(tuple(row) for row in await cur.fetchall())
+                await cur.close()
+        return res
+
+    async def get_grid_cells(self, z: int, tiles: list[tuple[int, int]]) -> dict[tuple[int, int], int]:
+        res = {}
+        chunk = 400
+        for i in range(0, len(tiles), chunk):
+            batch = tiles[i:i + chunk]
+            values = ",".join(["(?,?)"] * len(batch))
+            params = [z] + [v for t in batch for v in t]
+            cur = await self.conn.execute(f"SELECT x, y, pop FROM pop_grid WHERE z = ? AND (x, y) IN (VALUES {values})", params)
+            for row in await cur.fetchall():
+                res[(row[0], row[1])] = row[2]
+            await cur.close()
+        return res
+
+    async def get_row_by_geometry(self, cat: CensusCategory, geom: GeoJSON, bounds: tuple[float, float, float, float] | None = None) -> list[GeoRefPopQuery]:
+        return await self.get_row_by_polygon(cat, geom, bounds)
+
+    async def get_row_by_polygon(self, cat: CensusCategory, geom: GeoJSON, bounds: tuple[float, float, float, float] | None = None) -> list[GeoRefPopQuery]:
         match cat:
             case cat.state:
                 index = 'v_states'
@@ -76,17 +282,30 @@ class SqliteDB(DataBase):
                 table = 'blocks_clean'
             case _:
                 return []
-        geometry: shapely.Polygon | shapely.MultiPolygon | shapely.GeometryCollection = geom.to_shapely()
+        geometry: shapely.Polygon | shapely.MultiPolygon | shapely.GeometryCollection = await as_shapely(geom)
         if geometry is None:
             return[GeoRefPopQuery(geo_id = "",pop = -1, lon = 0, lat = 0)]
-        minX, minY, maxX, maxY = geometry.bounds #type: ignore
+        minX, minY, maxX, maxY = bounds or geometry.bounds #type: ignore
 
         match cat:
+            case cat.block if self.shard_dir is not None:
+                states = (await get_router(self)).states_for_geometry(geometry)
+                query_res = []
+                async with self._connections(cat, states) as conns:
+                    for conn in conns:
+                        cur = await conn.execute(f"""SELECT geo_id, pop, clon as lon, clat as lat
+                                                     FROM v_blocks
+                                                     WHERE minX >= ? AND minY >= ? AND maxX <= ? AND maxY <= ? AND pop != 0""",
+                                                 (minX, minY, maxX, maxY))
+                        query_res.extend(await cur.fetchall())
+                        await cur.close()
+
             case cat.block:
                 cur = await self.conn.execute(f"""SELECT geo_id, pop, clon as lon, clat as lat
                                              FROM v_blocks_clean
                                              WHERE minX >= ? AND minY >= ? AND maxX <= ? AND maxY <= ? AND pop != 0""",
                                          (minX, minY, maxX, maxY))
+                query_res = await cur.fetchall()
 
             case _:
                 cur = await self.conn.execute(f"""SELECT x.geo_id, x.pop, x.lon, x.lat FROM (
@@ -103,10 +322,8 @@ class SqliteDB(DataBase):
                                     ON {table}.geo_id = {index}.geo_id
                                 ) AS x
                             WHERE x.minX >= ? AND x.minY >= ? AND x.maxX <= ? AND x.maxY <= ? AND x.pop != 0""", (minX, minY, maxX, maxY))
-        query_res = await cur.fetchall()
+                query_res = await cur.fetchall()
         rows = [GeoRefPopQuery.parse_obj(row) for row in query_res]
-        res = []
-        for row in rows:
-            if shapely.contains(geometry, shapely.Point(row.lon, row.lat)):
-                res.append(row)
-        return res
+        if not rows:
+            return []
+        return await run_geometry(centroids_inside, geometry, rows)
@@ -0,0 +1,120 @@
+import numpy as np
+import shapely
+
+Point = tuple[int, int]
+
+def _polygons(geom) -> list:
+    match geom.geom_type:
+        case "Polygon":
+            return [geom]
+        case "MultiPolygon" | "GeometryCollection":
+            return [p for part in geom.geoms for p in _polygons(part)]
+        case _:
+            return []
+
+def _quantize_ring(coords: np.ndarray, translate: np.ndarray, scale: np.ndarray) -> list[Point]:
+    q = np.round((coords[:, :2] - translate) / scale).astype(np.int64)
+    keep = np.ones(len(q), dtype=bool)
+    keep[1:] = np.any(q[1:] != q[:-1], axis=1)
+    q = q[keep]
+    return [(int(x), int(y)) for x, y in q]
+
+class Topology:
+    """
+    Builds a TopoJSON topology from polygons. Coordinates are snapped to a
+    quantize x quantize grid over the bbox of the input, rings are cut into arcs
+    at junctions (points reached from more than two directions), and every arc
+    shared by two rings is stored once and referenced by both.
+    """
+    def __init__(self, geoms: list, quantize: float = 1e5):
+        self.geoms = geoms
+        n = max(int(quantize), 2)
+        bounds = shapely.total_bounds(geoms) if geoms else np.zeros(4)
+        self.translate = np.array(bounds[:2], dtype=np.float64)
+        span = np.array(bounds[2:], dtype=np.float64) - self.translate
+        self.scale = np.where(span > 0, span / (n - 1), 1.0)
+        self.arcs: list[list[Point]] = []
+        self.index: dict[tuple[Point, ...], int] = {}
+
+    def _rings(self) -> list[list[list[list[Point]]]]:
+        """Quantized closed rings, as geometry -> polygon -> ring."""
+        res = []
+        for geom in self.geoms:
+            polys = []
+            for poly in _polygons(geom):
+                rings = []
+                for ring in [poly.exterior, *poly.interiors]:
+                    pts = _quantize_ring(shapely.get_coordinates(ring), self.translate, self.scale)
+                    if len(pts) >= 4 and pts[0] == pts[-1]:
+                        rings.append(pts)
+                if rings:
+                    polys.append(rings)
+            res.append(polys)
+        return res
+
+    def _junctions(self, rings: list[list[list[list[Point]]]]) -> set[Point]:
+        neighbors: dict[Point, set[Point]] = {}
+        for polys in rings:
+            for poly in polys:
+                for ring in poly:
+                    n = len(ring) - 1
+                    for i in range(n):
+                        neighbors.setdefault(ring[i], set()).update((ring[i - 1 if i else n - 1], ring[i + 1]))
+        return {p for p, ns in neighbors.items() if len(ns) > 2}
+
+    def _arc_id(self, arc: list[Point]) -> int:
+        key = tuple(arc)
+        if key in self.index:
+            return self.index[key]
+        rev = key[::-1]
+        if rev in self.index:
+            return ~self.index[rev]
+        self.index[key] = len(self.arcs)
+        self.arcs.append(arc)
+        return self.index[key]
+
+    def _cut(self, ring: list[Point], junctions: set[Point]) -> list[int]:
+        pts = ring[:-1]
+        starts = [i for i, p in enumerate(pts) if p in junctions]
+        if not starts:
+            # A ring touching nothing is one arc; start it at its smallest point so
+            # the same ring from a neighbouring polygon dedupes.
+            i = pts.index(min(pts))
+            return [self._arc_id(pts[i:] + pts[:i] + [pts[i]])]
+        i = starts[0]
+        rotated = pts[i:] + pts[:i] + [pts[i]]
+        ids = []
+        start = 0
+        for j in range(1, len(rotated)):
+            if rotated[j] in junctions:
+                ids.append(self._arc_id(rotated[start:j + 1]))
+                start = j
+        return ids
+
+    def build(self) -> dict:
+        rings = self._rings()
+        junctions = self._junctions(rings)
+        geometries = []
+        for polys in rings:
+            arcs = [[self._cut(ring, junctions) for ring in poly] for poly in polys]
+            if len(arcs) == 1:
+                geometries.append({"type": "Polygon", "arcs": arcs[0]})
+            elif arcs:
+                geometries.append({"type": "MultiPolygon", "arcs": arcs})
+            else:
+                geometries.append({"type": None})
+        return {
+            "type": "Topology",
+            "transform": {"scale": self.scale.tolist(), "translate": self.translate.tolist()},
+            "objects": {"geometries": {"type": "GeometryCollection", "geometries": geometries}},
+            "arcs": [delta_encode(arc) for arc in self.arcs],
+        }
+
+def delta_encode(arc: list[Point]) -> list[list[int]]:
+    res = [[arc[0][0], arc[0][1]]]
+    for (x0, y0), (x1, y1) in zip(arc, arc[1:]):
+        res.append([x1 - x0, y1 - y0])
+    return res
+
+def to_topojson(geoms: list, quantize: float = 1e5) -> dict:
+    return Topology(geoms, quantize).build()
@@ -0,0 +1,52 @@
+from functools import lru_cache
+
+import numpy as np
+import shapely
+from pyproj import Transformer
+from shapely.geometry import mapping
+
+from .models import GeoJSON, Unit, conversion_to_m
+
+WGS84 = 4326
+
+def utm_epsg(lon: float, lat: float) -> int:
+    """EPSG code of the WGS84 UTM zone containing (lon, lat)."""
+    zone = int((lon + 180) // 6) + 1
+    zone = min(max(zone, 1), 60)
+    if lat >= 0:
+        return 32600 + zone
+    return 32700 + zone
+
+@lru_cache(maxsize=128)
+def get_transformers(epsg: int) -> tuple[Transformer, Transformer]:
+    """
+    Forward (lon/lat -> epsg) and inverse transformers. Building these is by far
+    the most expensive part of a buffer, so they are kept for the process lifetime.
+    """
+    fwd = Transformer.from_crs(WGS84, epsg, always_xy=True)
+    inv = Transformer.from_crs(epsg, WGS84, always_xy=True)
+    return fwd, inv
+
+def _apply(transformer: Transformer, geom):
+    def project(coords: np.ndarray) -> np.ndarray:
+        x, y = transformer.transform(coords[:, 0], coords[:, 1])
+        return np.column_stack((x, y))
+    return shapely.transform(geom, project)
+
+def buffer_shapely(geom, distance_m: float):
+    """Buffer a lon/lat shapely geometry by `distance_m` meters in its local UTM zone."""
+    if geom.is_empty:
+        return geom
+    center = geom.centroid
+    fwd, inv = get_transformers(utm_epsg(center.x, center.y))
+    projected = _apply(fwd, geom)
+    buffered = shapely.buffer(projected, distance_m)
+    return _apply(inv, buffered)
+
+def make_buffered_geo(geometry: GeoJSON, buffer: float, unit: Unit) -> GeoJSON:
+    geo = geometry.to_shapely()
+    if geo is None:
+        return geometry
+    distance = buffer * conversion_to_m[unit.value]
+    buffered = buffer_shapely(geo, distance)
+    return GeoJSON(**mapping(buffered), properties=geometry.properties)
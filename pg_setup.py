@@ -8,6 +8,7 @@ import zipfile
 
 from dotenv import load_dotenv
 from pathlib import Path
+from maushold.grid import MAX_LAT, MAX_LEVEL, MIN_LEVEL
 
 data_dir = Path("./data")
 load_dotenv()
@@ -50,6 +51,60 @@ def get_table(file: str) -> str | None:
         if file.find(cat) != -1:
             return cats[cat]
 
+def partition_blocks(conn: pg.Connection):
+    """
+    Rebuild blocks as a table LIST partitioned on the state FIPS prefix of geo_id,
+    with one partition per state. Indexes created on blocks afterwards cascade to
+    every partition.
+    """
+    states = [row[0] for row in conn.execute("SELECT geo_id FROM states ORDER BY geo_id").fetchall()]
+    conn.execute("""CREATE TABLE blocks_partitioned (
+                        LIKE blocks,
+                        state_fp CHAR(2) NOT NULL
+                    ) PARTITION BY LIST (state_fp);""")
+    for fp in states:
+        print("Making partition for state ", fp)
+        conn.execute(f"CREATE TABLE blocks_{fp} PARTITION OF blocks_partitioned FOR VALUES IN ('{fp}');".encode())
+    conn.execute("INSERT INTO blocks_partitioned SELECT blocks.*, LEFT(blocks.geo_id, 2) FROM blocks;")
+    conn.execute("DROP TABLE blocks;")
+    conn.execute("ALTER TABLE blocks_partitioned RENAME TO blocks;")
+
+def store_geojson(conn: pg.Connection, table: str):
+    """Keep every geometry as ready-to-send GeoJSON text so id lookups never re-encode it."""
+    conn.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS geojson TEXT;".encode())
+    conn.execute(f"UPDATE {table} SET geojson = ST_AsGeoJSON(geog);".encode())
+
+def make_pop_grid(conn: pg.Connection):
+    """
+    Sum block population into web mercator tiles at every pyramid level. The finest
+    level is computed from block centroids, each coarser one from the level below.
+    """
+    conn.execute("DROP TABLE IF EXISTS pop_grid;")
+    conn.execute("""CREATE TABLE pop_grid(
+                        z SMALLINT NOT NULL,
+                        x INTEGER NOT NULL,
+                        y INTEGER NOT NULL,
+                        pop BIGINT NOT NULL,
+                        PRIMARY KEY (z, x, y)
+                    );""")
+    print("Gridding blocks at level ", MAX_LEVEL)
+    conn.execute(f"""INSERT INTO pop_grid (z, x, y, pop)
+                     SELECT {MAX_LEVEL}, x, y, SUM(pop) FROM (
+                         SELECT floor((CAST(clon AS double precision) + 180) / 360 * 2 ^ {MAX_LEVEL})::integer AS x,
+                                floor((1 - asinh(tan(radians(LEAST(GREATEST(CAST(clat AS double precision), -{MAX_LAT}), {MAX_LAT})))) / pi()) / 2 * 2 ^ {MAX_LEVEL})::integer AS y,
+                                pop
+                         FROM blocks
+                         WHERE pop > 0
+                     ) AS t
+                     GROUP BY x, y;""".encode())
+    for z in range(MAX_LEVEL - 1, MIN_LEVEL - 1, -1):
+        print("Gridding blocks at level ", z)
+        conn.execute(f"""INSERT INTO pop_grid (z, x, y, pop)
+                         SELECT {z}, x / 2, y / 2, SUM(pop)
+                         FROM pop_grid
+                         WHERE z = {z + 1}
+                         GROUP BY x / 2, y / 2;""".encode())
+
 def get_all_files(directory: Path)->list[Path]:
     files = []
     for item in directory.iterdir():
@@ -60,11 +115,22 @@ def get_all_files(directory: Path)->list[Path]:
                 files.append(nested)
     return files
 
+def make_pattern_indexes(conn: pg.Connection, table: str):
+    """
+    Indexes for '*' id patterns, see maushold.patterns: text_pattern_ops lets
+    prefix LIKE use a btree under any collation, reverse(geo_id) does the same for
+    suffixes and the trigram GIN index covers infix matches.
+    """
+    conn.execute(f'CREATE INDEX "{table}_id_prefix" ON "{table}" ("geo_id" text_pattern_ops);'.encode())
+    conn.execute(f'CREATE INDEX "{table}_id_reverse" ON "{table}" (reverse("geo_id") text_pattern_ops);'.encode())
+    conn.execute(f'CREATE INDEX "{table}_id_trgm" ON "{table}" USING GIN ("geo_id" gin_trgm_ops);'.encode())
+
 
 if __name__ == "__main__":
     DSN = f"user={pg_user} password={pg_pass} host={pg_host} dbname={pg_db}"
     with pg.connect(DSN) as conn:
         conn.cursor().execute("CREATE EXTENSION IF NOT EXISTS postgis")
+        conn.cursor().execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
 
     first = {"states": True,
              "counties": True,
@@ -100,6 +166,7 @@ if __name__ == "__main__":
                  "ALTER TABLE blocks RENAME COLUMN intptlat20 TO clat;",
                  "ALTER TABLE blocks RENAME COLUMN geom TO geog;",
                  "ALTER TABLE blocks RENAME COLUMN pop20 TO pop;",
+                 "ALTER TABLE blocks RENAME COLUMN housing20 TO housing;",
 
                  "ALTER TABLE block_groups DROP COLUMN awater;",
                  "ALTER TABLE block_groups DROP COLUMN aland;",
@@ -110,6 +177,7 @@ if __name__ == "__main__":
                  "ALTER TABLE block_groups DROP COLUMN tractce;",
                  "ALTER TABLE block_groups DROP COLUMN blkgrpce;",
                  "ALTER TABLE block_groups ADD COLUMN pop INTEGER;",
+                 "ALTER TABLE block_groups ADD COLUMN housing INTEGER;",
                  "ALTER TABLE block_groups RENAME COLUMN geoid TO geo_id;",
                  "ALTER TABLE block_groups RENAME COLUMN geom TO geog;",
                  "ALTER TABLE block_groups RENAME COLUMN intptlon TO clon;",
@@ -123,6 +191,7 @@ if __name__ == "__main__":
                  "ALTER TABLE tracts DROP COLUMN countyfp;",
                  "ALTER TABLE tracts DROP COLUMN tractce;",
                  "ALTER TABLE tracts ADD COLUMN pop INTEGER;",
+                 "ALTER TABLE tracts ADD COLUMN housing INTEGER;",
                  "ALTER TABLE tracts RENAME COLUMN geoid TO geo_id;",
                  "ALTER TABLE tracts RENAME COLUMN geom TO geog;",
                  "ALTER TABLE tracts RENAME COLUMN intptlon TO clon;",
@@ -135,6 +204,7 @@ if __name__ == "__main__":
                  "ALTER TABLE counties DROP COLUMN statefp;",
                  "ALTER TABLE counties DROP COLUMN countyfp;",
                  "ALTER TABLE counties ADD COLUMN pop INTEGER;",
+                 "ALTER TABLE counties ADD COLUMN housing INTEGER;",
                  "ALTER TABLE counties RENAME COLUMN geoid TO geo_id;",
                  "ALTER TABLE counties RENAME COLUMN geom TO geog;",
                  "ALTER TABLE counties RENAME COLUMN intptlon TO clon;",
@@ -146,6 +216,7 @@ if __name__ == "__main__":
                  "ALTER TABLE states DROP COLUMN mtfcc;",
                  "ALTER TABLE states DROP COLUMN statefp;",
                  "ALTER TABLE states ADD COLUMN pop INTEGER;",
+                 "ALTER TABLE states ADD COLUMN housing INTEGER;",
                  "ALTER TABLE states RENAME COLUMN geoid TO geo_id;",
                  "ALTER TABLE states RENAME COLUMN geom TO geog;",
                  "ALTER TABLE states RENAME COLUMN intptlon TO clon;",
@@ -156,6 +227,9 @@ if __name__ == "__main__":
             print(stmt)
             conn.execute(stmt.encode())
 
+        print("Partitioning blocks by state")
+        partition_blocks(conn)
+
         for table in first:
             print("Making GIST index for ", table)
             sql = f'CREATE INDEX "{table}_goeg" ON "{table}" USING GIST("geog");'.encode()
@@ -163,14 +237,21 @@ if __name__ == "__main__":
             print("Making geoid index for ", table)
             sql = f'CREATE INDEX "{table}_id" ON "{table}" ("geo_id" ASC);'.encode()
             conn.execute(sql)
-            update = f"""UPDATE {table} SET pop = bar.pop FROM (SELECT geo_id, SUM(pop) as pop FROM (
-                            SELECT states.geo_id AS geo_id,
-                            blocks.pop as pop 
-                            FROM states
+            print("Making id pattern indexes for ", table)
+            make_pattern_indexes(conn, table)
+            update = f"""UPDATE {table} SET pop = bar.pop, housing = bar.housing FROM (SELECT geo_id, SUM(pop) as pop, SUM(housing) as housing FROM (
+                            SELECT {table}.geo_id AS geo_id,
+                            blocks.pop as pop,
+                            blocks.housing as housing
+                            FROM {table}
                             JOIN blocks
-                            ON blocks.geo_id ^@ states.geo_id) as foo
+                            ON blocks.geo_id ^@ {table}.geo_id) as foo
                             GROUP BY geo_id) AS bar
                         WHERE {table}.geo_id=bar.geo_id;
                     """
             if table != 'blocks':
                 conn.execute(update.encode())
+            print("Storing GeoJSON for ", table)
+            store_geojson(conn, table)
+
+        make_pop_grid(conn)
@@ -0,0 +1,67 @@
+#! /usr/bin/env python3
+import numpy as np
+import sqlite3
+import sys
+
+from maushold.shards import sources
+from maushold.snapshot import SNAPSHOT_DIR
+from numpy.lib.format import open_memmap
+from pathlib import Path
+
+BATCH_SIZE = 100_000
+
+def write_snapshot(dbs: list[sqlite3.Connection], table: str, out_dir: Path):
+    """
+    Write `table`, read from `dbs` in order, as fixed-width columns sorted by
+    geo_id. Geometries are concatenated into wkb.bin with row i spanning
+    wkb_offsets[i]:wkb_offsets[i+1].
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    counts = [db.execute(f"SELECT COUNT(*), MAX(LENGTH(geo_id)) FROM {table}").fetchone() for db in dbs]
+    n = sum(count[0] for count in counts)
+    width = max((count[1] or 1 for count in counts), default=1)
+
+    geo_id = open_memmap(out_dir / "geo_id.npy", mode="w+", dtype=f"S{width}", shape=(n,))
+    centroid = open_memmap(out_dir / "centroid.npy", mode="w+", dtype=np.float32, shape=(n, 2))
+    # float64 so bboxes stay exact; float32 rounding could drop units that only touch a query box.
+    bbox = open_memmap(out_dir / "bbox.npy", mode="w+", dtype=np.float64, shape=(n, 4))
+    pop = open_memmap(out_dir / "pop.npy", mode="w+", dtype=np.int32, shape=(n,))
+    housing = open_memmap(out_dir / "housing.npy", mode="w+", dtype=np.int32, shape=(n,))
+    offsets = open_memmap(out_dir / "wkb_offsets.npy", mode="w+", dtype=np.int64, shape=(n + 1,))
+
+    def batches():
+        for db in dbs:
+            cur = db.execute(f"""SELECT geo_id, clon, clat, minX, minY, maxX, maxY,
+                                        COALESCE(pop, 0), COALESCE(housing, 0), geometry
+                                 FROM {table}
+                                 ORDER BY geo_id""")
+            while rows := cur.fetchmany(BATCH_SIZE):
+                yield rows
+
+    i = 0
+    offset = 0
+    with (out_dir / "wkb.bin").open("wb") as blob:
+        for rows in batches():
+            j = i + len(rows)
+            geo_id[i:j] = [row[0].encode() for row in rows]
+            centroid[i:j] = [(row[1], row[2]) for row in rows]
+            bbox[i:j] = [row[3:7] for row in rows]
+            pop[i:j] = [row[7] for row in rows]
+            housing[i:j] = [row[8] for row in rows]
+            for k, row in enumerate(rows):
+                offsets[i + k] = offset
+                blob.write(row[9])
+                offset += len(row[9])
+            i = j
+    offsets[n] = offset
+    for arr in (geo_id, centroid, bbox, pop, housing, offsets):
+        arr.flush()
+
+
+if __name__ == "__main__":
+    db_path = sys.argv[1] if len(sys.argv) > 1 else "./data/census.db"
+
+    with sqlite3.connect(db_path) as conn:
+        for table in ["states", "counties", "tracts", "block_groups", "blocks"]:
+            print("Writing snapshot for ", table)
+            write_snapshot(sources(conn, table), table, SNAPSHOT_DIR / table)
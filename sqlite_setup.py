@@ -3,7 +3,10 @@ import geopandas as gpd
 import json
 import sqlite3
 import shapely.wkb as wkb
+import sys
 
+from maushold.grid import LEVELS, tile_xy
+from maushold.shards import SHARD_DIR
 from pathlib import Path
 from shapely.geometry import mapping
 
@@ -12,6 +15,9 @@ def make_geo_dataframe(path: Path) -> gpd.GeoDataFrame:
     print("reading df: ", path)
     return gpd.read_file(path)
 
+def to_geojson(geometry) -> str:
+    return json.dumps(mapping(geometry), separators=(",", ":"))
+
 def filter_gdf(df: gpd.GeoDataFrame, is_block = False):
     for _, row in df.iterrows():
         area = row.geometry.area
@@ -19,16 +25,17 @@ def filter_gdf(df: gpd.GeoDataFrame, is_block = False):
         if not is_block:
             yield (row["GEOID"], row["INTPTLAT"], row["INTPTLON"], 
                    bounds[0], bounds[1], bounds[2],
-                   bounds[3], wkb.dumps(row.geometry), area)
+                   bounds[3], wkb.dumps(row.geometry), to_geojson(row.geometry), area)
         else:
             yield (row["GEOID20"], row["INTPTLAT20"], row["INTPTLON20"], 
                    bounds[0], bounds[1], bounds[2],
-                   bounds[3], wkb.dumps(row.geometry), area, row["HOUSING20"], row["POP20"])
+                   bounds[3], wkb.dumps(row.geometry), to_geojson(row.geometry), area, row["HOUSING20"], row["POP20"])
 
 
 def create_table(db: sqlite3.Connection, table: str):
     insert_str = f"""CREATE TABLE IF NOT EXISTS {table}(
             geo_id TEXT PRIMARY KEY NOT NULL UNIQUE,
+            rev_id TEXT,
             clat REAL,
             clon REAL,
             minX REAL,
@@ -36,6 +43,7 @@ def create_table(db: sqlite3.Connection, table: str):
             maxX REAL,
             maxY REAL,
             geometry BLOB,
+            geojson TEXT,
             area REAL,
             housing INTEGER,
             pop INTEGER
@@ -44,9 +52,9 @@ def create_table(db: sqlite3.Connection, table: str):
 
 def populate_table(db: sqlite3.Connection, table: str, df: gpd.GeoDataFrame, is_block = False):
     if not is_block:
-        insert_str = f"INSERT INTO {table}(geo_id, clat, clon, minX, minY, maxX, maxY, geometry, area) VALUES(?,?,?,?,?,?,?,?,?)"
+        insert_str = f"INSERT INTO {table}(geo_id, clat, clon, minX, minY, maxX, maxY, geometry, geojson, area) VALUES(?,?,?,?,?,?,?,?,?,?)"
     else:
-        insert_str = f"INSERT INTO {table}(geo_id, clat, clon, minX, minY, maxX, maxY, geometry, area, housing, pop) VALUES(?,?,?,?,?,?,?,?,?,?,?)"
+        insert_str = f"INSERT INTO {table}(geo_id, clat, clon, minX, minY, maxX, maxY, geometry, geojson, area, housing, pop) VALUES(?,?,?,?,?,?,?,?,?,?,?,?)"
     db.executemany(insert_str, filter_gdf(df, is_block))
     db.commit()
 
@@ -79,6 +87,29 @@ def update_missing(db: sqlite3.Connection, df: gpd.GeoDataFrame):
     db.executemany(sql("states"), state_gen)
     db.commit()
 
+def create_grid_table(db: sqlite3.Connection):
+    db.execute("""CREATE TABLE IF NOT EXISTS pop_grid(
+            z INTEGER NOT NULL,
+            x INTEGER NOT NULL,
+            y INTEGER NOT NULL,
+            pop INTEGER NOT NULL,
+            PRIMARY KEY (z, x, y)
+            ) WITHOUT ROWID;""")
+
+def update_pop_grid(db: sqlite3.Connection, df: gpd.GeoDataFrame):
+    lon = df["INTPTLON20"].astype(float).to_numpy()
+    lat = df["INTPTLAT20"].astype(float).to_numpy()
+    sql = """
+        INSERT INTO pop_grid(z, x, y, pop) VALUES(?, ?, ?, ?)
+        ON CONFLICT(z, x, y) DO UPDATE SET pop = pop + excluded.pop;
+    """
+    for z in LEVELS:
+        x, y = tile_xy(lon, lat, z)
+        cells = df["POP20"].groupby([x, y]).sum()
+        cells = cells[cells > 0]
+        db.executemany(sql, ((z, int(cx), int(cy), int(p)) for (cx, cy), p in cells.items()))
+    db.commit()
+
 def create_id_index(conn: sqlite3.Connection, table: str):
     print("Indexing ", table)
     sql = f"""CREATE INDEX "{table}_id" ON "{table}" (
@@ -87,6 +118,23 @@ def create_id_index(conn: sqlite3.Connection, table: str):
     """
     conn.execute(sql)
     conn.commit()
+    create_pattern_indexes(conn, table)
+
+def create_pattern_indexes(conn: sqlite3.Connection, table: str):
+    """
+    Indexes for '*' id patterns, see maushold.patterns: rev_id holds the reversed
+    id so suffix patterns become prefix GLOBs on its index, and an FTS5 trigram
+    table over geo_id answers infix patterns.
+    """
+    print("Indexing id patterns for ", table)
+    conn.create_function("reverse", 1, lambda s: s[::-1], deterministic=True)
+    conn.execute(f'UPDATE "{table}" SET rev_id = reverse(geo_id)')
+    conn.execute(f'CREATE INDEX "{table}_rev_id" ON "{table}" ("rev_id" ASC)')
+    conn.execute(f"""CREATE VIRTUAL TABLE "{table}_trigram" USING fts5(
+                        geo_id, content='{table}', tokenize='trigram'
+                    )""")
+    conn.execute(f"""INSERT INTO "{table}_trigram"("{table}_trigram") VALUES('rebuild')""")
+    conn.commit()
 
 def create_rtree_index(db: sqlite3.Connection, table: str):
     cur = db.cursor()
@@ -110,9 +158,20 @@ def create_rtree_index(db: sqlite3.Connection, table: str):
                     FROM {table}
                    """)
     db.commit()
+def write_state_shard(df: gpd.GeoDataFrame, shard_dir: Path):
+    """Write the blocks of one state into their own database, with the same indexes as the main one."""
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    fp = df["STATEFP20"].iloc[0]
+    with sqlite3.connect(shard_dir / f"{fp}.db") as db:
+        create_table(db, "blocks")
+        populate_table(db, "blocks", df, True)
+        create_id_index(db, "blocks")
+        create_rtree_index(db, "blocks")
 
 
 if __name__ == "__main__":
+    # With --split-states blocks are written to one database per state instead of census.db.
+    split_states = "--split-states" in sys.argv
     data_dir = Path("./data")
     
     with sqlite3.connect("./data/census_test.db") as conn:
@@ -121,6 +180,7 @@ if __name__ == "__main__":
         create_table(conn, "block_groups")
         create_table(conn, "tracts")
         create_table(conn, "counties")
+        create_grid_table(conn)
 
         for file in (data_dir / "block_groups").iterdir():
             print("Working on file: ", file)
@@ -148,11 +208,18 @@ if __name__ == "__main__":
         for file in (data_dir / "blocks").iterdir():
             print("Working on file: ", file)
             df = make_geo_dataframe(file)
-            populate_table(conn, "blocks", df, True)
+            if split_states:
+                write_state_shard(df, SHARD_DIR)
+            else:
+                populate_table(conn, "blocks", df, True)
             update_missing(conn, df)
+            update_pop_grid(conn, df)
 
-        create_id_index(conn, "blocks")
+        tables = ["block_groups", "tracts", "counties", "states"]
+        if not split_states:
+            create_id_index(conn, "blocks")
+            tables.insert(0, "blocks")
 
-        for table in ["blocks", "block_groups", "tracts", "counties", "states"]:
+        for table in tables:
             print("Creating rtree for ", table)
             create_rtree_index(conn, table)